@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""Code to answer queries approximately on the `TDT4225ProjectGroup78` database.
+
+This module contains approximate versions of the counting, distinct user and
+distance queries. Documents are counted from the collection metadata instead
+of scanning the collections. Distinct users are counted with HyperLogLog
+sketches that are built at ingest and stored in the `sketch` collection. The
+distance walked in query 10 is estimated from a `$sample` of activities, with
+the sample size chosen to meet the error target of the query. Sketch and
+sample estimates are returned together with a confidence interval.
+"""
+import hashlib
+import math
+import statistics
+import numpy as np
+from bson.binary import Binary
+import queries
+
+# Precision of the HyperLogLog sketches, i.e. log2 of the number of registers.
+# 2^14 registers give a standard error of 0.8%.
+DEFAULT_PRECISION = 14
+
+# Default target relative half width of the confidence intervals
+DEFAULT_ERROR = 0.05
+
+# Number of activities in the pilot sample used to estimate the variance
+PILOT_SAMPLE_SIZE = 30
+
+
+class HyperLogLog:
+    """HyperLogLog sketch for estimating the number of distinct values.
+
+    Parameters
+    ----------
+    precision : int
+        log2 of the number of registers.
+    registers : :obj:`numpy.ndarray`, optional
+        Registers of an existing sketch.
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        self.precision = precision
+        self.m = 1 << precision
+        if registers is None:
+            registers = np.zeros(self.m, dtype=np.uint8)
+        self.registers = registers
+
+    def add(self, value):
+        """Add a value to the sketch.
+
+        Parameters
+        ----------
+        value : object
+            The value. Values are hashed by their string representation.
+        """
+        digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+        h = int.from_bytes(digest, "big")
+        index = h >> (64 - self.precision)
+        # Position of the leftmost 1-bit in the remaining bits
+        remaining = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        """Add several values to the sketch."""
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        """Merge another sketch of the same precision into this sketch."""
+        if other.precision != self.precision:
+            raise ValueError("Can not merge sketches of different precision.")
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    @property
+    def standard_error(self):
+        """The relative standard error of the estimate."""
+        return 1.04 / math.sqrt(self.m)
+
+    def count(self):
+        """Estimate the number of distinct values added to the sketch.
+
+        Returns
+        -------
+        float
+            The estimate.
+        """
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(float)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        # Small range correction
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * math.log(m / zeros)
+        return float(estimate)
+
+    def to_document(self, name):
+        """Serialize the sketch to a MongoDB document."""
+        return {
+            "_id": name,
+            "precision": self.precision,
+            "registers": Binary(self.registers.tobytes()),
+        }
+
+    @classmethod
+    def from_document(cls, document):
+        """Deserialize a sketch from a MongoDB document."""
+        registers = np.frombuffer(document["registers"], dtype=np.uint8).copy()
+        return cls(document["precision"], registers)
+
+
+def build_sketches(db, user_dict, activity_dict, precision=DEFAULT_PRECISION):
+    """Build the distinct user sketches and merge them into `sketch`.
+
+    Sketches are merged with those already stored, so ingesting additional
+    data keeps the sketches up to date.
+
+    Parameters
+    ----------
+    db : :obj:
+        The pymongo database object.
+    user_dict : list of dict
+        Collection of users.
+    activity_dict : list of dict
+        Collection of activities.
+    precision : int
+        log2 of the number of registers of each sketch.
+    """
+    user_of_activity = {
+        aid: user["_id"] for user in user_dict for aid in user["activity_id"]
+    }
+    sketches = {"users": HyperLogLog(precision)}
+    sketches["users"].update(user["_id"] for user in user_dict)
+    sketches["multiday_users"] = HyperLogLog(precision)
+
+    for activity in activity_dict:
+        uid = user_of_activity.get(activity["_id"])
+        if uid is None:
+            continue
+        # Activities that start one day and end on another
+        if activity["end_date_time"].date() > activity["start_date_time"].date():
+            sketches["multiday_users"].add(uid)
+        mode = activity["transportation_mode"]
+        if isinstance(mode, str):
+            name = f"mode:{mode}"
+            sketches.setdefault(name, HyperLogLog(precision)).add(uid)
+
+    collection = db["sketch"]
+    for name, sketch in sketches.items():
+        stored = collection.find_one({"_id": name})
+        if stored is not None and stored["precision"] == precision:
+            sketch.merge(HyperLogLog.from_document(stored))
+        collection.replace_one({"_id": name}, sketch.to_document(name), upsert=True)
+
+
+def _z(confidence):
+    """Return the two sided standard normal quantile for a confidence level."""
+    return statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+
+
+def _sketch_estimate(sketch, confidence, error):
+    """Return the estimate and confidence interval of a sketch."""
+    estimate = sketch.count()
+    half_width = _z(confidence) * sketch.standard_error * estimate
+    return {
+        "Estimate": round(estimate, 1),
+        "ConfidenceInterval": [
+            round(max(0.0, estimate - half_width), 1),
+            round(estimate + half_width, 1),
+        ],
+        "Confidence": confidence,
+        "ErrorTargetMet": _z(confidence) * sketch.standard_error <= error,
+    }
+
+
+def sample_size(values, population, error, confidence):
+    """Return the sample size needed to meet a relative error target.
+
+    The size is derived from the coefficient of variation of a pilot sample,
+    with the finite population correction.
+
+    Parameters
+    ----------
+    values : list of float
+        The values of the pilot sample.
+    population : int
+        The number of units in the population.
+    error : float
+        Target relative half width of the confidence interval of the total.
+    confidence : float
+        Confidence level of the interval.
+
+    Returns
+    -------
+    int
+        The sample size, at most `population`.
+    """
+    if len(values) < 2:
+        return population
+    mean = statistics.mean(values)
+    if mean == 0:
+        # No variation can be estimated, so the whole population is needed
+        return population if statistics.stdev(values) > 0 else len(values)
+    cv = statistics.stdev(values) / mean
+    n = (_z(confidence) * cv / error) ** 2
+    n = math.ceil(n / (1 + n / population))  # finite population correction
+    return min(population, max(n, len(values)))
+
+
+def estimate_total(values, population, confidence):
+    """Estimate a population total from a simple random sample.
+
+    Parameters
+    ----------
+    values : list of float
+        The values of the sampled units.
+    population : int
+        The number of units in the population.
+    confidence : float
+        Confidence level of the interval.
+
+    Returns
+    -------
+    dict
+        The estimate and its confidence interval.
+    """
+    n = len(values)
+    estimate = population * statistics.mean(values)
+    if 1 < n < population:
+        standard_error = population * statistics.stdev(values) / math.sqrt(n)
+        standard_error *= math.sqrt(1 - n / population)
+    else:
+        standard_error = 0.0
+    half_width = _z(confidence) * standard_error
+    return {
+        "Estimate": estimate,
+        "ConfidenceInterval": [max(0.0, estimate - half_width), estimate + half_width],
+        "Confidence": confidence,
+    }
+
+
+def _sample_activities(activity, activity_ids, size, exclude=()):
+    """Return the ids of a random sample of the given activities."""
+    sample = activity.aggregate(
+        [
+            {"$match": {"_id": {"$in": activity_ids, "$nin": list(exclude)}}},
+            {"$sample": {"size": size}},
+            {"$project": {"_id": 1}},
+        ]
+    )
+    return [item["_id"] for item in sample]
+
+
+def approx_query_1(
+    user, activity, trackpoint, error=DEFAULT_ERROR, confidence=0.95
+):
+    """Find approximate answers to question 1.
+
+    The number of users, activities and trackpoints are read from the
+    collection metadata, which is exact after a clean shutdown and does not
+    scan the collections, so no sampling is needed.
+
+    Parameters
+    ----------
+    user : :obj:
+        The pymongo collection object for user.
+    activity : :obj:
+        The pymongo collection object for activity.
+    trackpoint : :obj:
+        The pymongo collection object for trackpoint.
+    error : float
+        Unused, for the same signature as the other approximate queries.
+    confidence : float
+        Unused, for the same signature as the other approximate queries.
+
+    Returns
+    -------
+    list of dict
+        One document per collection with its number of documents.
+    """
+    return [
+        {
+            "_id": "Users",
+            "NumberOfUsers": user.estimated_document_count(),
+            "Method": "metadata",
+        },
+        {
+            "_id": "Activities",
+            "NumberOfActivities": activity.estimated_document_count(),
+            "Method": "metadata",
+        },
+        {
+            "_id": "Trackpoints",
+            "NumberOfTrackpoints": trackpoint.estimated_document_count(),
+            "Method": "metadata",
+        },
+    ]
+
+
+def approx_query_4(sketch, error=DEFAULT_ERROR, confidence=0.95):
+    """Find approximate answers to question 4 from the HyperLogLog sketches.
+
+    Parameters
+    ----------
+    sketch : :obj:
+        The pymongo collection object for sketch.
+    error : float
+        Target relative half width of the confidence interval.
+    confidence : float
+        Confidence level of the interval.
+
+    Returns
+    -------
+    list of dict
+        A document with the estimated number of users with activities that
+        start one day and end on another.
+    """
+    document = sketch.find_one({"_id": "multiday_users"})
+    if document is None:
+        raise ValueError("The HyperLogLog sketches were not built at ingest.")
+    estimate = _sketch_estimate(HyperLogLog.from_document(document), confidence, error)
+    return [{"_id": "UsersWithDifferentStartAndEndDate", "numberOfUsers": estimate}]
+
+
+def approx_query_8(sketch, error=DEFAULT_ERROR, confidence=0.95):
+    """Find approximate answers to question 8 from the HyperLogLog sketches.
+
+    Parameters
+    ----------
+    sketch : :obj:
+        The pymongo collection object for sketch.
+    error : float
+        Target relative half width of the confidence interval.
+    confidence : float
+        Confidence level of the interval.
+
+    Returns
+    -------
+    list of dict
+        A document per transportation mode with the estimated number of
+        distinct users.
+    """
+    result = []
+    for document in sketch.find({"_id": {"$regex": "^mode:"}}).sort("_id", 1):
+        estimate = _sketch_estimate(
+            HyperLogLog.from_document(document), confidence, error
+        )
+        result.append({"_id": document["_id"][len("mode:") :], "myCount": estimate})
+    return result
+
+
+def approx_query_10(
+    user,
+    activity,
+    trackpoint,
+    error=DEFAULT_ERROR,
+    confidence=0.95,
+    partition_granularity=None,
+):
+    """Find approximate answers to question 10 from a sample of activities.
+
+    The total distance walked is estimated from the distances of a `$sample`
+    of the walking activities of the user, so only the trackpoints of the
+    sampled activities are read. A pilot sample estimates the variance of the
+    distances, from which the sample size needed to meet the error target is
+    derived.
+
+    Parameters
+    ----------
+    user : :obj:
+        The pymongo collection object for user.
+    activity : :obj:
+        The pymongo collection object for activity.
+    trackpoint : :obj:
+        The pymongo collection object for trackpoint, or for the simplified
+        trackpoint tier.
+    error : float
+        Target relative half width of the confidence interval.
+    confidence : float
+        Confidence level of the interval.
+    partition_granularity : str, optional
+        The partition granularity of the trackpoints, used to prune
+        partitions outside 2008. None if they are not partitioned.
+
+    Returns
+    -------
+    list of dict
+        A document with the estimated distance walked in kilometers.
+    """
+    user = user.find_one({"_id": "112"})
+    activities = activity.find(
+        {"_id": {"$in": user["activity_id"]}, "transportation_mode": "walk"},
+        {"_id": 1},
+    )
+    activity_ids = [item["_id"] for item in activities]
+    N = len(activity_ids)
+    if N == 0:
+        return [{"_id": "DistanceWalked", "Kilometers": 0.0, "Method": "no activities"}]
+
+    # Pilot sample, then extend it to the size required by the error target
+    sampled = _sample_activities(activity, activity_ids, min(PILOT_SAMPLE_SIZE, N))
+    distances = queries.walked_distances(trackpoint, sampled, partition_granularity)
+    n = sample_size(list(distances.values()), N, error, confidence)
+    if n > len(distances):
+        sampled = _sample_activities(
+            activity, activity_ids, n - len(distances), sampled
+        )
+        distances.update(
+            queries.walked_distances(trackpoint, sampled, partition_granularity)
+        )
+
+    estimate = estimate_total(list(distances.values()), N, confidence)
+    return [
+        {
+            "_id": "DistanceWalked",
+            "Kilometers": {
+                "Estimate": round(estimate["Estimate"], 1),
+                "ConfidenceInterval": [
+                    round(bound, 1) for bound in estimate["ConfidenceInterval"]
+                ],
+                "Confidence": confidence,
+            },
+            "Method": f"sample of {len(distances)} of {N} activities",
+        }
+    ]
+
+
+# Approximate query functions keyed on question number, with the names of the
+# collections each function takes as arguments (in order).
+APPROXIMATE = {
+    1: (approx_query_1, ("user", "activity", "trackpoint")),
+    4: (approx_query_4, ("sketch",)),
+    8: (approx_query_8, ("sketch",)),
+    10: (approx_query_10, ("user", "activity", "trackpoint")),
+}
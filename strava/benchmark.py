@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+"""Code to benchmark ingest and queries on the `TDT4225ProjectGroup78` database.
+
+This module contains a benchmark harness that times `parse_data`, each stage
+of `insert_data` (insertion of the user, activity and trackpoint collections,
+index creation, sketches, simplification and rollups) and each variant of
+each query function. Every benchmark is run a number of warmup trials followed by a
+number of measured trials. For each measured trial the wall time, the peak
+resident set size of the Python process and the number of documents (and
+index keys) scanned by the MongoDB server are recorded.
+
+The benchmarks run against a throwaway `mongod` started in a temporary
+directory, or against an existing server given by its URI. Results are written
+as JSON so that runs can be compared across commits with `compare`.
+"""
+import argparse
+import contextlib
+import datetime
+import functools
+import io
+import json
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pymongo import MongoClient
+from tabulate import tabulate
+import approximate
+import database
+import partition
+import queries
+import rollup
+import simplify
+from connection import Connection
+from memory import PeakRSS
+
+# Tolerance in meters of the simplified trackpoint tier that is benchmarked
+SIMPLIFY_TOLERANCE = 10
+
+# Partition granularity of the partitioned query variants
+PARTITION_GRANULARITY = "year"
+
+
+class ThrowawayMongod:
+    """Context manager running a temporary `mongod` server.
+
+    The server stores its data in a temporary directory which is removed
+    together with the server when the context is exited.
+
+    Parameters
+    ----------
+    mongod : str
+        The `mongod` executable.
+    startup_timeout : float
+        Seconds to wait for the server to accept connections.
+    """
+
+    def __init__(self, mongod="mongod", startup_timeout=30):
+        self.mongod = mongod
+        self.startup_timeout = startup_timeout
+        self.uri = None
+        self._dbpath = None
+        self._process = None
+
+    def __enter__(self):
+        executable = shutil.which(self.mongod)
+        if executable is None:
+            raise RuntimeError(f"Could not find `{self.mongod}` on PATH.")
+        self._dbpath = tempfile.mkdtemp(prefix="strava-bench-")
+        port = _free_port()
+        self._process = subprocess.Popen(
+            [
+                executable,
+                "--dbpath",
+                self._dbpath,
+                "--port",
+                str(port),
+                "--bind_ip",
+                "127.0.0.1",
+                "--quiet",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        self.uri = f"mongodb://127.0.0.1:{port}/"
+
+        # Wait for the server to accept connections
+        deadline = time.time() + self.startup_timeout
+        while True:
+            try:
+                with MongoClient(self.uri, serverSelectionTimeoutMS=500) as client:
+                    client.admin.command("ping")
+                break
+            except Exception:
+                if self._process.poll() is not None or time.time() > deadline:
+                    self.__exit__(None, None, None)
+                    raise RuntimeError("Throwaway mongod failed to start.")
+                time.sleep(0.2)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._process is not None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+            self._process = None
+        if self._dbpath is not None:
+            shutil.rmtree(self._dbpath, ignore_errors=True)
+            self._dbpath = None
+
+
+def _free_port():
+    """Return a free TCP port on the loopback interface."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _scanned(client):
+    """Return the server wide number of documents and keys scanned.
+
+    Parameters
+    ----------
+    client : :obj:
+        The pymongo client.
+
+    Returns
+    -------
+    tuple of int
+        The number of documents and index keys scanned since server start.
+    """
+    metrics = client.admin.command("serverStatus")["metrics"]["queryExecutor"]
+    return metrics["scannedObjects"], metrics["scanned"]
+
+
+def _git_commit():
+    """Return the current git commit hash, or None outside a git repository."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(name, func, client, setup=None, warmup=1, trials=5):
+    """Run a single benchmark.
+
+    Parameters
+    ----------
+    name : str
+        The name of the benchmark.
+    func : callable
+        The function to benchmark. Called without arguments.
+    client : :obj:
+        The pymongo client used to read the server scan counters.
+    setup : callable, optional
+        Called without arguments before every trial. Not timed.
+    warmup : int
+        Number of untimed warmup trials.
+    trials : int
+        Number of measured trials.
+
+    Returns
+    -------
+    dict
+        The benchmark name, the measurements of each trial and a summary.
+    """
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+
+    results = []
+    for _ in range(trials):
+        if setup is not None:
+            setup()
+        docs_before, keys_before = _scanned(client)
+        with PeakRSS() as rss, contextlib.redirect_stdout(io.StringIO()):
+            start_time = time.perf_counter()
+            func()
+            wall_time = time.perf_counter() - start_time
+        docs_after, keys_after = _scanned(client)
+        results.append(
+            {
+                "wall_time": wall_time,
+                "peak_rss": rss.peak,
+                "docs_scanned": docs_after - docs_before,
+                "keys_scanned": keys_after - keys_before,
+            }
+        )
+
+    wall_times = [r["wall_time"] for r in results]
+    summary = {
+        "wall_time_min": min(wall_times),
+        "wall_time_median": statistics.median(wall_times),
+        "wall_time_mean": statistics.mean(wall_times),
+        "peak_rss_max": max(r["peak_rss"] for r in results),
+        "docs_scanned_median": statistics.median(r["docs_scanned"] for r in results),
+    }
+    print(f"{name}: median {summary['wall_time_median']:.3f} seconds")
+    return {"name": name, "trials": results, "summary": summary}
+
+
+def _query_variants(number):
+    """Return the dispatched variants of a query.
+
+    Parameters
+    ----------
+    number : int
+        The question number.
+
+    Returns
+    -------
+    list of tuple
+        The benchmark name, query function, collection names and keyword
+        arguments of each variant: the scanning version, and the rollup,
+        approximate, simplified and partitioned versions where they exist.
+    """
+    query, collection_names = queries.QUERIES[number]
+    variants = [(f"query_{number}", query, collection_names, {})]
+    if number in rollup.ROLLUP:
+        variants.append((f"query_{number}_rollup", *rollup.ROLLUP[number], {}))
+    if number in approximate.APPROXIMATE:
+        variants.append(
+            (f"query_{number}_approximate", *approximate.APPROXIMATE[number], {})
+        )
+    if number in queries.SIMPLIFIABLE:
+        simplified_names = [
+            "trackpoint_simplified" if name == "trackpoint" else name
+            for name in collection_names
+        ]
+        variants.append((f"query_{number}_simplified", query, simplified_names, {}))
+    if number in queries.PARTITIONABLE:
+        variants.append(
+            (
+                f"query_{number}_partitioned",
+                query,
+                collection_names,
+                {"partition_granularity": PARTITION_GRANULARITY},
+            )
+        )
+    return variants
+
+
+def run_suite(connection, warmup=1, trials=5, query_numbers=None, drop=False):
+    """Benchmark parsing, ingest and queries against a MongoDB server.
+
+    The database is dropped before it is filled with data, and again when
+    the suite has finished. An existing database is only dropped if `drop` is
+    True.
+
+    The stages of `insert_data` are benchmarked separately on the parsed
+    data: inserting each collection, creating the trackpoint index, building
+    the sketches, simplifying the trackpoints and building the rollups. Every
+    trial starts from the state before the stage, and the database is left
+    filled, with every tier, for the query benchmarks. Each query is
+    benchmarked in every variant `query_database` can dispatch it to, so the
+    rollup, approximate, simplified and partitioned versions can be compared
+    with the scanning version.
+
+    Parameters
+    ----------
+    connection : :obj:`connection.Connection`
+        The shared connection to the database.
+    warmup : int
+        Number of untimed warmup trials per benchmark.
+    trials : int
+        Number of measured trials per benchmark.
+    query_numbers : list of int, optional
+        The queries to benchmark. All queries if not given.
+    drop : bool
+        Whether to drop the database if it already exists.
+
+    Returns
+    -------
+    list of dict
+        The results of each benchmark.
+    """
+    if query_numbers is None:
+        query_numbers = list(queries.QUERIES)
+
+    client = connection.client
+    if connection.db_name in client.list_database_names() and not drop:
+        raise RuntimeError(
+            f"Database `{connection.db_name}` already exists. Use another "
+            f"--db-name, or --drop to drop it before benchmarking."
+        )
+    client.drop_database(connection.db_name)
+    try:
+        db = connection.db
+        results = []
+
+        def bench(name, func, setup=None):
+            results.append(
+                run_benchmark(name, func, client, setup, warmup=warmup, trials=trials)
+            )
+
+        # Parsing
+        parsed = {}
+
+        def parse():
+            parsed["data"] = database.parse_data()
+
+        bench("parse_data", parse)
+        user_dict, activity_dict, trackpoint_dict = parsed.pop("data")
+        # Partition keys are stored for the partitioned query variants
+        partition.add_partition_keys(trackpoint_dict, PARTITION_GRANULARITY)
+
+        # Ingest stages. The parsed documents already have an `_id`, so
+        # insert_many does not modify them and they can be inserted repeatedly.
+        data = {
+            "user": user_dict,
+            "activity": activity_dict,
+            "trackpoint": trackpoint_dict,
+        }
+        for name, records in data.items():
+            collection = db[name]
+            bench(
+                f"insert_{name}",
+                lambda: collection.insert_many(records),
+                setup=collection.drop,
+            )
+        bench(
+            "create_indexes",
+            lambda: db["trackpoint"].create_index("activity_id"),
+            setup=db["trackpoint"].drop_indexes,
+        )
+        bench(
+            "build_sketches",
+            lambda: approximate.build_sketches(db, user_dict, activity_dict),
+            setup=db["sketch"].drop,
+        )
+        simplified = {}
+
+        def simplify_trackpoints():
+            simplified["data"] = simplify.simplify_trackpoints(
+                trackpoint_dict, SIMPLIFY_TOLERANCE
+            )
+
+        bench("simplify_trackpoints", simplify_trackpoints)
+        bench("update_rollups", lambda: rollup.update_rollups(db))
+
+        # Remaining tiers, untimed
+        db["trackpoint_simplified"].insert_many(simplified.pop("data"))
+        db["trackpoint_simplified"].create_index("activity_id")
+        partition.create_partition_index(db["trackpoint"])
+        del data, user_dict, activity_dict, trackpoint_dict
+
+        # Queries
+        for number in query_numbers:
+            for name, query, collection_names, kwargs in _query_variants(number):
+                args = [db[collection_name] for collection_name in collection_names]
+                bench(name, functools.partial(query, *args, **kwargs))
+        return results
+    finally:
+        # The database was created by the suite
+        client.drop_database(connection.db_name)
+
+
+def write_results(results, path, warmup, trials):
+    """Write benchmark results to a JSON file.
+
+    Parameters
+    ----------
+    results : list of dict
+        The results of each benchmark.
+    path : str
+        The output path.
+    warmup : int
+        Number of untimed warmup trials per benchmark.
+    trials : int
+        Number of measured trials per benchmark.
+    """
+    output = {
+        "commit": _git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "warmup": warmup,
+        "trials": trials,
+        "benchmarks": results,
+    }
+    with open(path, "w") as f:
+        json.dump(output, f, indent=2)
+
+
+def compare(baseline_path, candidate_path):
+    """Print a comparison of two benchmark result files.
+
+    Parameters
+    ----------
+    baseline_path : str
+        Path to the baseline results.
+    candidate_path : str
+        Path to the candidate results.
+    """
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    with open(candidate_path, "r") as f:
+        candidate = json.load(f)
+
+    baseline_summary = {b["name"]: b["summary"] for b in baseline["benchmarks"]}
+    rows = []
+    for benchmark in candidate["benchmarks"]:
+        before = baseline_summary.get(benchmark["name"])
+        if before is None:
+            continue
+        after = benchmark["summary"]
+        rows.append(
+            [
+                benchmark["name"],
+                before["wall_time_median"],
+                after["wall_time_median"],
+                after["wall_time_median"] / before["wall_time_median"],
+                before["peak_rss_max"] / 2 ** 20,
+                after["peak_rss_max"] / 2 ** 20,
+                before["docs_scanned_median"],
+                after["docs_scanned_median"],
+            ]
+        )
+    headers = [
+        "benchmark",
+        "baseline (s)",
+        "candidate (s)",
+        "ratio",
+        "baseline RSS (MiB)",
+        "candidate RSS (MiB)",
+        "baseline docs",
+        "candidate docs",
+    ]
+    print(f"Baseline: {baseline['commit']}, candidate: {candidate['commit']}")
+    print(tabulate(rows, headers=headers, floatfmt=".3f", tablefmt="orgtbl"))
+
+
+def main(argv=None):
+    """Run the benchmark suite from the command line.
+
+    Parameters
+    ----------
+    argv : list of str, optional
+        The command line arguments. `sys.argv` if not given.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--uri", help="benchmark an existing server instead of a throwaway mongod"
+    )
+    parser.add_argument("--mongod", default="mongod", help="mongod executable")
+    parser.add_argument(
+        "--db-name",
+        default="TDT4225Benchmark",
+        help="database to fill and query, dropped first (default TDT4225Benchmark)",
+    )
+    parser.add_argument(
+        "--drop",
+        action="store_true",
+        help="drop the database if it already exists on the server",
+    )
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument(
+        "--queries",
+        type=lambda s: [int(n) for n in s.split(",")],
+        help="comma separated query numbers, e.g. 6,11",
+    )
+    parser.add_argument("--output", help="path of the JSON results file")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASELINE", "CANDIDATE"),
+        help="compare two results files instead of running benchmarks",
+    )
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.uri:
+        server = contextlib.nullcontext()
+    else:
+        server = ThrowawayMongod(args.mongod)
+    with server as mongod:
+        uri = args.uri or mongod.uri
+        with Connection(None, None, None, args.db_name, uri=uri) as connection:
+            try:
+                results = run_suite(
+                    connection, args.warmup, args.trials, args.queries, args.drop
+                )
+            except RuntimeError as e:
+                sys.exit(str(e))
+
+    output = args.output
+    if output is None:
+        commit = (_git_commit() or "nocommit")[:8]
+        timestamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+        output = f"bench-{commit}-{timestamp}.json"
+    write_results(results, output, args.warmup, args.trials)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Code to cache query results on disk.
+
+This module contains a least recently used cache for the results of the query
+functions. Results are keyed on the query name, its parameters and the epoch
+of the ingested dataset. `insert_data` writes a new epoch on every ingest, so
+cached results of a previous ingest are never returned and are removed on the
+next lookup.
+"""
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from pymongo.collection import Collection
+
+
+class ResultCache:
+    """Least recently used on-disk cache for query results.
+
+    Each result is pickled to its own file named after the dataset epoch and a
+    hash of the query name and parameters. The modification time of a file is
+    used as its last access time.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to store cached results in.
+    max_entries : int
+        The maximum number of cached results. The least recently used results
+        are evicted first.
+    """
+
+    def __init__(self, directory=".query_cache", max_entries=64):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def fetch(self, name, epoch, func, *args, **kwargs):
+        """Return the cached result of `func`, computing it on a cache miss.
+
+        Parameters
+        ----------
+        name : str
+            The query name.
+        epoch : str or None
+            The dataset epoch. Nothing is cached if None.
+        func : callable
+            The query function.
+        *args, **kwargs
+            The arguments to `func`. Collections are keyed on their full name.
+
+        Returns
+        -------
+        object
+            The result of `func(*args, **kwargs)`.
+        """
+        if epoch is None:
+            return func(*args, **kwargs)
+
+        path = self._path(name, epoch, args, kwargs)
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+            # Mark as recently used
+            os.utime(path)
+            return result
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+
+        result = func(*args, **kwargs)
+        # Write to a temporary file first so readers never see partial results
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self._evict(epoch)
+        return result
+
+    def clear(self):
+        """Remove all cached results."""
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".pkl"):
+                os.remove(os.path.join(self.directory, filename))
+
+    def _path(self, name, epoch, args, kwargs):
+        """Return the path of the cache file for a query call."""
+        key = json.dumps(
+            [name, [_key_part(a) for a in args], _key_part(kwargs)],
+            sort_keys=True,
+        )
+        digest = hashlib.sha256(key.encode()).hexdigest()[:32]
+        return os.path.join(self.directory, f"{epoch}-{digest}.pkl")
+
+    def _evict(self, epoch):
+        """Remove results of other epochs and the least recently used results."""
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".pkl"):
+                continue
+            path = os.path.join(self.directory, filename)
+            if not filename.startswith(f"{epoch}-"):
+                os.remove(path)
+                continue
+            entries.append((os.path.getmtime(path), path))
+        entries.sort()
+        for _, path in entries[: max(0, len(entries) - self.max_entries)]:
+            os.remove(path)
+
+
+def _key_part(value):
+    """Convert a query argument to a JSON serializable cache key part."""
+    if isinstance(value, Collection):
+        return f"collection:{value.full_name}"
+    if isinstance(value, dict):
+        return {str(k): _key_part(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_key_part(v) for v in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return repr(value)
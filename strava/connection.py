@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Code to connect to the `TDT4225ProjectGroup78` MongoDB database.
+
+This module contains a connection object holding a single pymongo client, and
+thereby a single connection pool, that is shared by user creation, ingest and
+the queries. The pool size, timeouts, wire compression and read preference of
+the client are configurable.
+"""
+from urllib.parse import quote_plus
+from pymongo import MongoClient
+
+
+class Connection:
+    """Shared MongoDB client for the `TDT4225ProjectGroup78` database.
+
+    The client is created on first use and closed by `close` or when the
+    connection is used as a context manager.
+
+    Parameters
+    ----------
+    USER : str or None
+        The MongoDB user. No credentials are sent if None.
+    PASSWORD : str or None
+        The MongoDB password.
+    HOST : str
+        The MongoDB host, optionally with a port.
+    DB_NAME : str
+        The MongoDB database name (`TDT4225ProjectGroup78`).
+    max_pool_size : int
+        Maximum number of pooled connections to the server.
+    min_pool_size : int
+        Number of connections kept open in the pool.
+    compressors : str, optional
+        Comma separated wire compressors in order of preference, e.g.
+        `zstd,snappy,zlib`. `zstd` and `snappy` require the `zstandard` and
+        `python-snappy` packages.
+    read_preference : str
+        The read preference, e.g. `primary` or `secondaryPreferred`.
+    timeout_ms : int
+        Server selection and connect timeout in milliseconds.
+    monitor : :obj:`monitoring.CommandMonitor`, optional
+        Command monitor registered with the client.
+    uri : str, optional
+        Connection string to use instead of one built from the login
+        information.
+    """
+
+    def __init__(
+        self,
+        USER,
+        PASSWORD,
+        HOST,
+        DB_NAME,
+        max_pool_size=100,
+        min_pool_size=0,
+        compressors=None,
+        read_preference="primary",
+        timeout_ms=30000,
+        monitor=None,
+        uri=None,
+    ):
+        if uri is None:
+            if USER is not None:
+                # Escape reserved characters such as `@`, `:` and `/`
+                uri = (
+                    f"mongodb://{quote_plus(USER)}:{quote_plus(PASSWORD)}"
+                    f"@{HOST}/{DB_NAME}"
+                )
+            else:
+                uri = f"mongodb://{HOST}/{DB_NAME}"
+        self.uri = uri
+        self.user = USER
+        self.password = PASSWORD
+        self.db_name = DB_NAME
+        self.monitor = monitor
+        self.options = {
+            "maxPoolSize": max_pool_size,
+            "minPoolSize": min_pool_size,
+            "readPreference": read_preference,
+            "serverSelectionTimeoutMS": timeout_ms,
+            "connectTimeoutMS": timeout_ms,
+        }
+        if compressors:
+            self.options["compressors"] = compressors
+        self._client = None
+
+    @property
+    def client(self):
+        """The pymongo client, created on first use."""
+        if self._client is None:
+            event_listeners = [self.monitor] if self.monitor is not None else []
+            self._client = MongoClient(
+                self.uri, event_listeners=event_listeners, **self.options
+            )
+        return self._client
+
+    @property
+    def db(self):
+        """The pymongo database object."""
+        return self.client[self.db_name]
+
+    def close(self):
+        """Close the client and its connection pool."""
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
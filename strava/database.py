@@ -10,22 +10,27 @@ performed on the database.
 import os
 import pandas as pd
 import numpy as np
-from pymongo import MongoClient
+from contextlib import nullcontext
 import time
+import statistics
+import uuid
+import datetime
 import queries
+import simplify
+import approximate
+import rollup
+import partition
+import export
+import memory
 
 
-def parse_data():
-    """Parse data from `.plt` files into collection dictionaries.
+def _parse_users():
+    """Find the users and whether they have labeled activities.
 
     Returns
     -------
-    user_dict : dict
-        Collection of users.
-    activity_dict : dict
-        Collection of users.
-    trackpoint_dict : dict
-        Collection of trackpoints.
+    user_df : :obj:`pandas.DataFrame`
+        The users, with columns `id` and `has_labels`.
     """
     # Load user data into Pandas DataFrame
     user_ids = sorted(os.listdir("../dataset/Data/"))
@@ -35,8 +40,28 @@ def parse_data():
     with open("../dataset/labeled_ids.txt", "r") as f:
         labeled_users = f.read().splitlines()
     has_labels = [True if uid in labeled_users else False for uid in user_ids]
-    user_df = pd.DataFrame({"id": user_ids, "has_labels": has_labels})
+    return pd.DataFrame({"id": user_ids, "has_labels": has_labels})
+
+
+def _parse_trajectories(uid, aid):
+    """Parse the `.plt` files of a user into activities and trackpoints.
 
+    Parameters
+    ----------
+    uid : str
+        The user id.
+    aid : int
+        The id of the first activity of the user.
+
+    Returns
+    -------
+    activity_ll : list of :obj:`pandas.Series`
+        The activities of the user.
+    trackpoint_ll : list of :obj:`pandas.DataFrame`
+        The trackpoints of each activity.
+    aid : int
+        The id of the next activity.
+    """
     # Trackpoint columns
     trackpoint_cols = ["lat", "lon", "ignore", "altitude", "date_days", "date", "time"]
 
@@ -44,95 +69,162 @@ def parse_data():
     trackpoint_ll = []
     activity_ll = []
 
-    aid = 0
-    for uid in user_ids:
-        user_path = f"../dataset/Data/{uid}/"
-        trajectory_path = user_path + "Trajectory/"
-
-        # Load labels if they exist
-        labels = []
-        if os.path.exists(user_path + "labels.txt"):
-            labels = pd.read_csv(user_path + "labels.txt", sep="\t")
-            labels["Start Time"] = pd.to_datetime(labels["Start Time"])
-            labels["End Time"] = pd.to_datetime(labels["End Time"])
-
-        for filename in os.listdir(trajectory_path):
-            # Load trackpoints
-            df = pd.read_csv(
-                trajectory_path + filename, skiprows=6, names=trackpoint_cols
-            )
-            # Ignore if more than 2500 records
-            if len(df) > 2500:
-                continue
-            # Convert to datetime
-            df["date_time"] = pd.to_datetime(df["date"] + " " + df["time"])
-            df = df.drop(columns=["date", "time", "ignore"])
-
-            # Create activity record
-            activity = {}
-            activity["id"] = aid
-            activity["user_id"] = uid
-            activity["start_date_time"] = df["date_time"].iloc[0]
-            activity["end_date_time"] = df["date_time"].iloc[-1]
-            activity["transportation_mode"] = np.nan
-
-            # Find transportation mode
-            # Makes sure that duplicate labels are handled by adding additional
-            # Activities
-            if len(labels) > 0:
-                # Find labels that matches the current trackpoint start and
-                # end time
-                temp_df = labels.loc[
-                    (labels["Start Time"] == activity["start_date_time"])
-                    & (labels["End Time"] == activity["end_date_time"])
-                ]
-                # If empty, add current activity to list
-                if len(temp_df) == 0:
+    user_path = f"../dataset/Data/{uid}/"
+    trajectory_path = user_path + "Trajectory/"
+
+    # Load labels if they exist
+    labels = []
+    if os.path.exists(user_path + "labels.txt"):
+        labels = pd.read_csv(user_path + "labels.txt", sep="\t")
+        labels["Start Time"] = pd.to_datetime(labels["Start Time"])
+        labels["End Time"] = pd.to_datetime(labels["End Time"])
+
+    for filename in os.listdir(trajectory_path):
+        # Abort or switch to the chunked path before running out of memory
+        memory.checkpoint()
+
+        # Load trackpoints
+        df = pd.read_csv(
+            trajectory_path + filename, skiprows=6, names=trackpoint_cols
+        )
+        # Ignore if more than 2500 records
+        if len(df) > 2500:
+            continue
+        # Convert to datetime
+        df["date_time"] = pd.to_datetime(df["date"] + " " + df["time"])
+        df = df.drop(columns=["date", "time", "ignore"])
+
+        # Create activity record
+        activity = {}
+        activity["id"] = aid
+        activity["user_id"] = uid
+        activity["start_date_time"] = df["date_time"].iloc[0]
+        activity["end_date_time"] = df["date_time"].iloc[-1]
+        activity["transportation_mode"] = np.nan
+
+        # Find transportation mode
+        # Makes sure that duplicate labels are handled by adding additional
+        # Activities
+        if len(labels) > 0:
+            # Find labels that matches the current trackpoint start and
+            # end time
+            temp_df = labels.loc[
+                (labels["Start Time"] == activity["start_date_time"])
+                & (labels["End Time"] == activity["end_date_time"])
+            ]
+            # If empty, add current activity to list
+            if len(temp_df) == 0:
+                # Add aid to trackpoint
+                df["activity_id"] = aid
+
+                trackpoint_ll.append(df)
+                activity_ll.append(pd.Series(activity))
+
+                # increment aid
+                aid += 1
+            # Else, loop through entries in the labels and add new
+            # activities for each match
+            else:
+                for tm in temp_df["Transportation Mode"].values:
                     # Add aid to trackpoint
                     df["activity_id"] = aid
 
+                    # Create new activity
+                    activity = {}
+                    activity["id"] = aid
+                    activity["user_id"] = uid
+                    activity["start_date_time"] = df["date_time"].iloc[0]
+                    activity["end_date_time"] = df["date_time"].iloc[-1]
+                    activity["transportation_mode"] = tm
+
                     trackpoint_ll.append(df)
                     activity_ll.append(pd.Series(activity))
 
                     # increment aid
                     aid += 1
-                # Else, loop through entries in the labels and add new
-                # activities for each match
-                else:
-                    for tm in temp_df["Transportation Mode"].values:
-                        # Add aid to trackpoint
-                        df["activity_id"] = aid
-
-                        # Create new activity
-                        activity = {}
-                        activity["id"] = aid
-                        activity["user_id"] = uid
-                        activity["start_date_time"] = df["date_time"].iloc[0]
-                        activity["end_date_time"] = df["date_time"].iloc[-1]
-                        activity["transportation_mode"] = tm
-
-                        trackpoint_ll.append(df)
-                        activity_ll.append(pd.Series(activity))
-
-                        # increment aid
-                        aid += 1
-            # If there's no match, add current activity
-            else:
-                # Add aid to trackpoint
-                df["activity_id"] = aid
-                trackpoint_ll.append(df)
+        # If there's no match, add current activity
+        else:
+            # Add aid to trackpoint
+            df["activity_id"] = aid
+            trackpoint_ll.append(df)
 
-                activity_ll.append(pd.Series(activity))
-                # increment aid
-                aid += 1
+            activity_ll.append(pd.Series(activity))
+            # increment aid
+            aid += 1
+
+    return activity_ll, trackpoint_ll, aid
+
+
+def _records(df, batch_size=100000):
+    """Convert a DataFrame to a list of records, checking the memory budget.
+
+    Parameters
+    ----------
+    df : :obj:`pandas.DataFrame`
+        The DataFrame.
+    batch_size : int
+        Number of rows converted between checks of the memory budget.
+
+    Returns
+    -------
+    list of dict
+        The rows of `df`, as `df.to_dict("records")`.
+    """
+    records = []
+    for start in range(0, len(df), batch_size):
+        memory.checkpoint()
+        records.extend(df.iloc[start : start + batch_size].to_dict("records"))
+    return records
 
-    # Create dataframes from saved lists
-    trackpoint_df = pd.concat(trackpoint_ll).reset_index(drop=True)
-    trackpoint_df["id"] = [i for i in range(len(trackpoint_df))]
-    activity_df = pd.DataFrame().append(activity_ll)
+
+def _to_records(
+    user_df, activity_ll, trackpoint_ll, first_trackpoint_id=0, stage=None
+):
+    """Convert parsed data into collection dictionaries.
+
+    Parameters
+    ----------
+    user_df : :obj:`pandas.DataFrame`
+        The users, with columns `id` and `has_labels`.
+    activity_ll : list of :obj:`pandas.Series`
+        The activities of the users.
+    trackpoint_ll : list of :obj:`pandas.DataFrame`
+        The trackpoints of each activity.
+    first_trackpoint_id : int
+        The id of the first trackpoint.
+    stage : callable, optional
+        `MemoryProfiler.stage`, to profile concatenating the DataFrames and
+        converting them to dictionaries as separate stages.
+
+    Returns
+    -------
+    user_dict : dict
+        Collection of users.
+    activity_dict : dict
+        Collection of activities.
+    trackpoint_dict : dict
+        Collection of trackpoints.
+    """
+    if stage is None:
+        stage = lambda name: nullcontext()
+
+    if not trackpoint_ll:
+        user_df = user_df.rename(columns={"id": "_id"})
+        user_df["activity_id"] = [[] for _ in range(len(user_df))]
+        return (user_df.to_dict("records"), [], [])
+
+    # Create dataframes from saved lists. The per-file DataFrames and their
+    # concatenation are both held in memory until the lists are released.
+    memory.checkpoint()
+    with stage("concat"):
+        trackpoint_df = pd.concat(trackpoint_ll).reset_index(drop=True)
+        trackpoint_ll.clear()
+        memory.checkpoint()
+    trackpoint_df["id"] = [i + first_trackpoint_id for i in range(len(trackpoint_df))]
+    activity_df = pd.DataFrame(activity_ll)
 
     # Replace -777 as it is an invalid altitude
-    trackpoint_df["altitude"].replace(-777, np.nan, inplace=True)
+    trackpoint_df["altitude"] = trackpoint_df["altitude"].replace(-777, np.nan)
 
     # Changes to data structures for mongoDB
     # Rename columns
@@ -154,15 +246,158 @@ def parse_data():
     # Drop column
     activity_df = activity_df.drop(columns=["user_id"])
 
-    # Create dicts
+    # Create dicts. The trackpoint dicts are by far the largest copy, so they
+    # are created in batches, checking the memory budget in between.
     user_dict = user_df.to_dict("records")
     activity_dict = activity_df.to_dict("records")
-    trackpoint_dict = trackpoint_df.to_dict("records")
+    with stage("to_dict"):
+        trackpoint_dict = _records(trackpoint_df)
 
     return (user_dict, activity_dict, trackpoint_dict)
 
 
-def create_user(USER, PASSWORD, HOST, DB_NAME):
+def parse_data(stage=None):
+    """Parse data from `.plt` files into collection dictionaries.
+
+    Parameters
+    ----------
+    stage : callable, optional
+        `MemoryProfiler.stage`, to profile reading the files, concatenating
+        the DataFrames and converting them to dictionaries as separate stages.
+
+    Returns
+    -------
+    user_dict : dict
+        Collection of users.
+    activity_dict : dict
+        Collection of users.
+    trackpoint_dict : dict
+        Collection of trackpoints.
+    """
+    if stage is None:
+        stage = lambda name: nullcontext()
+
+    user_df = _parse_users()
+
+    # lists to store dataframes
+    trackpoint_ll = []
+    activity_ll = []
+
+    aid = 0
+    with stage("read_files"):
+        for uid in user_df["id"]:
+            user_activity_ll, user_trackpoint_ll, aid = _parse_trajectories(uid, aid)
+            activity_ll.extend(user_activity_ll)
+            trackpoint_ll.extend(user_trackpoint_ll)
+
+    return _to_records(user_df, activity_ll, trackpoint_ll, stage=stage)
+
+
+def iter_parse_data(users_per_chunk=10):
+    """Parse data from `.plt` files into collection dictionaries in chunks.
+
+    Only the data of `users_per_chunk` users is held in memory at a time. The
+    activity and trackpoint ids are the same as those of `parse_data`.
+
+    Parameters
+    ----------
+    users_per_chunk : int
+        Number of users per chunk.
+
+    Yields
+    ------
+    user_dict : dict
+        Collection of the users in the chunk.
+    activity_dict : dict
+        Collection of their activities.
+    trackpoint_dict : dict
+        Collection of their trackpoints.
+    """
+    user_df = _parse_users()
+
+    aid = 0
+    first_trackpoint_id = 0
+    for start in range(0, len(user_df), users_per_chunk):
+        chunk_df = user_df.iloc[start : start + users_per_chunk]
+        trackpoint_ll = []
+        activity_ll = []
+        for uid in chunk_df["id"]:
+            user_activity_ll, user_trackpoint_ll, aid = _parse_trajectories(uid, aid)
+            activity_ll.extend(user_activity_ll)
+            trackpoint_ll.extend(user_trackpoint_ll)
+        records = _to_records(chunk_df, activity_ll, trackpoint_ll, first_trackpoint_id)
+        first_trackpoint_id += len(records[2])
+        yield records
+
+
+def write_epoch(db, layout=None):
+    """Write a new dataset epoch to the `meta` collection.
+
+    The epoch identifies the ingested dataset version and is used to
+    invalidate cached query results.
+
+    Parameters
+    ----------
+    db : :obj:
+        The pymongo database object.
+    layout : dict, optional
+        Description of the optional collections built at ingest, e.g. the
+        tolerance of the simplified trackpoint tier.
+
+    Returns
+    -------
+    str
+        The new epoch.
+    """
+    epoch = uuid.uuid4().hex
+    db["meta"].replace_one(
+        {"_id": "dataset"},
+        {
+            "_id": "dataset",
+            "epoch": epoch,
+            "ingested_at": datetime.datetime.utcnow(),
+            "layout": layout or {},
+        },
+        upsert=True,
+    )
+    return epoch
+
+
+def read_epoch(db):
+    """Read the dataset epoch from the `meta` collection.
+
+    Parameters
+    ----------
+    db : :obj:
+        The pymongo database object.
+
+    Returns
+    -------
+    str or None
+        The epoch, or None if no ingest has completed.
+    """
+    meta = db["meta"].find_one({"_id": "dataset"})
+    return meta["epoch"] if meta is not None else None
+
+
+def read_layout(db):
+    """Read the layout of the ingested dataset from the `meta` collection.
+
+    Parameters
+    ----------
+    db : :obj:
+        The pymongo database object.
+
+    Returns
+    -------
+    dict
+        The layout written by `write_epoch`, empty if no ingest has completed.
+    """
+    meta = db["meta"].find_one({"_id": "dataset"})
+    return meta.get("layout", {}) if meta is not None else {}
+
+
+def create_user(connection):
     """Create MongoDB user for the `TDT4225ProjectGroup78` database.
 
     First drops the database, then creates a user with the given login
@@ -170,27 +405,75 @@ def create_user(USER, PASSWORD, HOST, DB_NAME):
 
     Parameters
     ----------
-    USER : str
-        The entered MongoDB user.
-    PASSWORD : str
-        The entered MongoDB password.
-    HOST : str
-        The entered MongoDB host.
-    DB_NAME : str
-        The MongoDB database name (`TDT4225ProjectGroup78`).
+    connection : :obj:`connection.Connection`
+        The shared connection to the database.
 
     """
-    uri = f"mongodb://{USER}:{PASSWORD}@{HOST}/{DB_NAME}"
-    with MongoClient(uri) as client:
-        # Start by dropping the database.
-        client.drop_database(DB_NAME)
+    # Start by dropping the database.
+    connection.client.drop_database(connection.db_name)
 
-        # Add the user to the database.
-        db = client[DB_NAME]
-        db.add_user(USER,PASSWORD)
+    # Add the user to the database.
+    connection.db.add_user(connection.user, connection.password)
 
 
-def insert_data(USER, PASSWORD, HOST, DB_NAME):
+def _insert_records(
+    db,
+    user_dict,
+    activity_dict,
+    trackpoint_dict,
+    simplify_tolerance=None,
+    partition_granularity=None,
+):
+    """Insert parsed records into the collections.
+
+    Parameters
+    ----------
+    db : :obj:
+        The pymongo database object.
+    user_dict : dict
+        Collection of users.
+    activity_dict : dict
+        Collection of activities.
+    trackpoint_dict : dict
+        Collection of trackpoints.
+    simplify_tolerance : float, optional
+        If given, also insert the trackpoints simplified to this tolerance in
+        meters into `trackpoint_simplified`.
+    partition_granularity : str, optional
+        If given, add the partition key to the trackpoints.
+
+    Returns
+    -------
+    int
+        The number of simplified trackpoints inserted.
+    """
+    # insert_many raises on empty lists
+    if user_dict:
+        db["user"].insert_many(user_dict)
+    if activity_dict:
+        db["activity"].insert_many(activity_dict)
+    if partition_granularity is not None:
+        partition.add_partition_keys(trackpoint_dict, partition_granularity)
+    if trackpoint_dict:
+        db["trackpoint"].insert_many(trackpoint_dict)
+    approximate.build_sketches(db, user_dict, activity_dict)
+
+    if simplify_tolerance is None:
+        return 0
+    simplified_dict = simplify.simplify_trackpoints(trackpoint_dict, simplify_tolerance)
+    if simplified_dict:
+        db["trackpoint_simplified"].insert_many(simplified_dict)
+    return len(simplified_dict)
+
+
+def insert_data(
+    connection,
+    simplify_tolerance=None,
+    partition_granularity=None,
+    profiler=None,
+    chunked=False,
+    users_per_chunk=10,
+):
     """Create collections and insert data.
 
     Inserts the parsed data from the `.plt` files into the
@@ -198,121 +481,324 @@ def insert_data(USER, PASSWORD, HOST, DB_NAME):
 
     Parameters
     ----------
-    USER : str
-        The entered MongoDB user.
-    PASSWORD : str
-        The entered MongoDB password.
-    HOST : str
-        The entered MongoDB host.
-    DB_NAME : str
-        The MongoDB database name (`TDT4225ProjectGroup78`).
+    connection : :obj:`connection.Connection`
+        The shared connection to the database.
+    simplify_tolerance : float, optional
+        If given, also create the `trackpoint_simplified` collection with the
+        trajectory of each activity simplified to this tolerance in meters.
+    partition_granularity : str, optional
+        If given (`year` or `month`), add an indexed `partition` key to the
+        trackpoints so time bounded queries can prune partitions.
+    profiler : :obj:`memory.MemoryProfiler`, optional
+        If given, record the memory use of each ingest stage.
+    chunked : bool
+        Whether to parse and insert `users_per_chunk` users at a time instead
+        of the whole dataset at once. Also used when parsing the whole dataset
+        exceeds the memory budget and the budget policy is `chunk`. The memory
+        budget then applies to the memory growth of each chunk.
+    users_per_chunk : int
+        Number of users per chunk.
+
+    Raises
+    ------
+    :obj:`memory.MemoryBudgetExceeded`
+        If the memory budget is exceeded and can not be met by chunking. The
+        dataset is then left incomplete and not marked as loaded.
 
     """
-    start_time = time.time()
-    print('Parsing data...')
-    user_dict, activity_dict, trackpoint_dict = parse_data()
-    print(
-        f"Data parsed successfully. Time taken: {time.time() - start_time:.2f} seconds"
-    )
+    stage = profiler.stage if profiler is not None else (lambda name: nullcontext())
 
-    uri = f"mongodb://{USER}:{PASSWORD}@{HOST}/{DB_NAME}"
-    with MongoClient(uri) as client:
-        # Create database
-        db = client[DB_NAME]
+    # Create database
+    db = connection.db
 
-        # Create collections
-        user = db["user"]
-        activity = db["activity"]
-        trackpoint = db["trackpoint"]
+    # Invalidate the current dataset version while data is inserted
+    db["meta"].delete_one({"_id": "dataset"})
+    db["trackpoint_simplified"].drop()
 
-        # Insert data
+    if not chunked:
         start_time = time.time()
-        user.insert_many(user_dict)
+        print('Parsing data...')
+        try:
+            with stage("parse_data"):
+                user_dict, activity_dict, trackpoint_dict = parse_data(stage)
+        except memory.MemoryBudgetExceeded as e:
+            if memory.budget_policy() != "chunk":
+                raise
+            print(f"{e} Falling back to chunked ingest.")
+            chunked = True
+        else:
+            print(
+                f"Data parsed successfully. Time taken: {time.time() - start_time:.2f} seconds"
+            )
+
+    # Index used to look up the trackpoints of activities
+    db["trackpoint"].create_index("activity_id")
+
+    if chunked:
+        start_time = time.time()
+        number_of_trackpoints = 0
+        number_of_simplified = 0
+        db["activity_distance"].drop()
+        db["rollup"].drop()
+        number_of_users = 0
+        chunks = iter_parse_data(users_per_chunk)
+        try:
+            with stage("chunked_ingest"):
+                while True:
+                    # Memory freed by earlier chunks, or by an aborted parse of
+                    # the whole dataset, is rarely returned to the operating
+                    # system, so each chunk is held to the budget on its own
+                    with memory.relative_budget():
+                        records = next(chunks, None)
+                        if records is None:
+                            break
+                        number_of_simplified += _insert_records(
+                            db, *records, simplify_tolerance, partition_granularity
+                        )
+                    number_of_users += len(records[0])
+                    number_of_trackpoints += len(records[2])
+                    # Each chunk holds whole users, so their rollups are complete
+                    activity_ids = [activity["_id"] for activity in records[1]]
+                    if activity_ids:
+                        rollup.update_rollups(db, activity_ids)
+                    del records
+        except memory.MemoryBudgetExceeded as e:
+            print(
+                f"Chunked ingest aborted after {number_of_users} users: {e} "
+                f"The dataset is incomplete. Reload it with a larger budget or "
+                f"fewer --users-per-chunk."
+            )
+            raise
         print(
-            f"User collection created successfully. Time taken: {time.time() - start_time:.2f} seconds"
+            f"Collections created successfully in chunks of {users_per_chunk} users. "
+            f"Time taken: {time.time() - start_time:.2f} seconds"
+        )
+    else:
+        start_time = time.time()
+        with stage("insert"):
+            number_of_simplified = _insert_records(
+                db,
+                user_dict,
+                activity_dict,
+                trackpoint_dict,
+                simplify_tolerance,
+                partition_granularity,
+            )
+        number_of_trackpoints = len(trackpoint_dict)
+        del user_dict, activity_dict, trackpoint_dict
+        print(
+            f"Collections created successfully. Time taken: {time.time() - start_time:.2f} seconds"
         )
 
         start_time = time.time()
-        activity.insert_many(activity_dict)
+        with stage("rollups"):
+            rollup.update_rollups(db)
         print(
-            f"Activity collection created successfully. Time taken: {time.time() - start_time:.2f} seconds"
+            f"Rollup collection created successfully. Time taken: {time.time() - start_time:.2f} seconds"
         )
 
+    layout = {"rollups": True}
+    if partition_granularity is not None:
         start_time = time.time()
-        trackpoint.insert_many(trackpoint_dict)
+        partition.create_partition_index(db["trackpoint"])
+        layout["partition_granularity"] = partition_granularity
         print(
-            f"Trackpoint collection created successfully. Time taken: {time.time() - start_time:.2f} seconds"
+            f"Partition index created successfully. Time taken: {time.time() - start_time:.2f} seconds"
+        )
+    if simplify_tolerance is not None:
+        start_time = time.time()
+        db["trackpoint_simplified"].create_index("activity_id")
+        if partition_granularity is not None:
+            partition.create_partition_index(db["trackpoint_simplified"])
+        layout["simplify_tolerance"] = simplify_tolerance
+        print(
+            f"Simplified trackpoint collection created successfully "
+            f"({number_of_simplified} of {number_of_trackpoints} trackpoints). "
+            f"Time taken: {time.time() - start_time:.2f} seconds"
         )
 
+    write_epoch(db, layout)
 
-def query_database(USER, PASSWORD, HOST, DB_NAME):
-    """Call the different query functions.
+
+def dataset_loaded(connection):
+    """Check whether the database holds a completely ingested dataset.
 
     Parameters
     ----------
-    USER : str
-        The entered MongoDB user
-    PASSWORD : str
-        The entered MongoDB password
-    HOST: str
-        The entered MongoDB host
-    DB_NAME : str
-        The MongoDB database name (`TDT4225ProjectGroup78`)
-    """
-
-    # Instantiate connection
-    uri = f"mongodb://{USER}:{PASSWORD}@{HOST}/{DB_NAME}"
-    with MongoClient(uri) as client:
-
-        db = client["TDT4225ProjectGroup78"]
-        user = db["user"]
-        activity = db["activity"]
-        trackpoint = db["trackpoint"]
-
-        # Query 1
-        print("Query 1:")
-        queries.query_1(user, activity, trackpoint)
-
-        # Query 2
-        print("Query 2:")
-        queries.query_2(user)
-
-        # Query 3
-        print("Query 3:")
-        queries.query_3(user)
+    connection : :obj:`connection.Connection`
+        The shared connection to the database.
 
-        # Query 4
-        print("Query 4:")
-        queries.query_4(activity)
+    Returns
+    -------
+    bool
+        True if an ingest has completed since the database was last dropped.
+    """
+    return read_epoch(connection.db) is not None
+
+
+def query_database(
+    connection,
+    query_numbers=None,
+    repeat=1,
+    cache=None,
+    tier="full",
+    mode="exact",
+    error=approximate.DEFAULT_ERROR,
+    confidence=0.95,
+    use_rollups=True,
+    export_dir=None,
+    export_format="parquet",
+    profiler=None,
+):
+    """Call the different query functions.
 
-        # Query 5
-        print("Query 5:")
-        queries.query_5(activity)
+    Each query is run `repeat` times. The result of the first run is printed,
+    followed by the time taken. If the connection has a command monitor, a
+    summary table is printed after the queries have finished.
 
-        # Query 6
-        print("Query 6:")
-        queries.query_6(user, trackpoint)
+    With the `simplified` tier, the spatial queries in
+    `queries.SIMPLIFIABLE` read the `trackpoint_simplified` collection
+    instead of `trackpoint`. Every discarded trackpoint lies within the
+    simplification tolerance of the simplified trajectory, and distances are
+    lower bounds of the exact distances.
 
-        # Query 7
-        print("Query 7:")
-        queries.query_7(user, activity)
+    In `approximate` mode, the queries in `approximate.APPROXIMATE` are
+    answered from collection metadata, HyperLogLog sketches and samples, the
+    latter two with confidence intervals in the output. The sample sizes are
+    chosen to meet the error target of each query. The remaining queries are
+    answered exactly.
 
-        # Query 8
-        print("Query 8:")
-        queries.query_8(activity)
+    If the trackpoints were partitioned at ingest, the queries in
+    `queries.PARTITIONABLE` are given the partition granularity to prune
+    partitions outside their time range.
 
-        # Query 9
-        print("Query 9:")
-        queries.query_9(user, activity)
+    If the rollups were built at ingest, the queries in `rollup.ROLLUP` read
+    the pre-aggregated `rollup` collection, unless answered approximately.
 
-        # Query 10
-        print("Query 10:")
-        queries.query_10(user, activity, trackpoint)
+    Parameters
+    ----------
+    connection : :obj:`connection.Connection`
+        The shared connection to the database.
+    query_numbers : list of int, optional
+        The queries to run. All queries if not given.
+    repeat : int
+        Number of times to run each query.
+    cache : :obj:`cache.ResultCache`, optional
+        Cache for the query results, keyed on the dataset epoch.
+    tier : str
+        The trackpoint tier, `full` or `simplified`.
+    mode : str
+        The execution mode, `exact` or `approximate`.
+    error : float or dict
+        Target relative half width of the confidence intervals in
+        `approximate` mode, or a dict of targets keyed on query number.
+        Queries not in the dict use `approximate.DEFAULT_ERROR`.
+    confidence : float
+        Confidence level of the intervals in `approximate` mode.
+    use_rollups : bool
+        Whether to answer queries from the rollups when they are available.
+    export_dir : str, optional
+        Directory to export each query result to, as `query_N.parquet` or
+        `query_N.arrow`.
+    export_format : str
+        `parquet` or `ipc`.
+    profiler : :obj:`memory.MemoryProfiler`, optional
+        If given, record the memory use of each query. A query exceeding the
+        memory budget is aborted, and the remaining queries are run.
+    """
+    stage = profiler.stage if profiler is not None else (lambda name: nullcontext())
+    db = connection.db
+    monitor = connection.monitor
+    epoch = read_epoch(db) if cache is not None else None
+
+    if tier not in ("full", "simplified"):
+        raise ValueError(f"Unknown trackpoint tier `{tier}`.")
+    if mode not in ("exact", "approximate"):
+        raise ValueError(f"Unknown execution mode `{mode}`.")
+
+    layout = read_layout(db)
+    use_rollups = use_rollups and layout.get("rollups", False)
+
+    # Queries reading the simplified trackpoint tier
+    tolerance = layout.get("simplify_tolerance")
+    if tier == "simplified":
+        if tolerance is None:
+            raise ValueError("The simplified trackpoint tier was not built at ingest.")
+        simplified = queries.SIMPLIFIABLE
+    else:
+        simplified = {}
+
+    if query_numbers is None:
+        query_numbers = list(queries.QUERIES)
+    if export_dir is not None:
+        os.makedirs(export_dir, exist_ok=True)
+
+    for number in query_numbers:
+        query, collection_names = queries.QUERIES[number]
+        kwargs = {}
+        if mode == "approximate" and number in approximate.APPROXIMATE:
+            query, collection_names = approximate.APPROXIMATE[number]
+            if isinstance(error, dict):
+                kwargs = {"error": error.get(number, approximate.DEFAULT_ERROR)}
+            else:
+                kwargs = {"error": error}
+            kwargs["confidence"] = confidence
+        elif use_rollups and number in rollup.ROLLUP:
+            query, collection_names = rollup.ROLLUP[number]
+        if layout.get("partition_granularity") and number in queries.PARTITIONABLE:
+            kwargs["partition_granularity"] = layout["partition_granularity"]
+        print(f"Query {number}:")
+        if number in simplified:
+            print(
+                f"Using simplified trackpoints within {tolerance} meters of the "
+                f"full trajectories: {simplified[number]}"
+            )
+            collection_names = [
+                "trackpoint_simplified" if name == "trackpoint" else name
+                for name in collection_names
+            ]
+        args = [db[name] for name in collection_names]
+        timings = []
+        try:
+            with stage(f"query_{number}"):
+                for run in range(repeat):
+                    if monitor is not None:
+                        label = monitor.label(f"Query {number}")
+                    else:
+                        label = nullcontext()
+                    start_time = time.time()
+                    with label:
+                        if cache is not None:
+                            result = cache.fetch(
+                                query.__name__, epoch, query, *args, **kwargs
+                            )
+                        else:
+                            result = query(*args, **kwargs)
+                    timings.append(time.time() - start_time)
+                    if run == 0:
+                        queries.print_result(result)
+                        if export_dir is not None:
+                            extension = export.FORMATS[export_format]
+                            path = os.path.join(
+                                export_dir, f"query_{number}.{extension}"
+                            )
+                            export.export_result(result, path, export_format)
+        except memory.MemoryBudgetExceeded as e:
+            print(f"Query {number} aborted: {e}")
+            continue
+        if repeat > 1:
+            print(
+                f"Time taken over {repeat} runs: min {min(timings):.2f}, "
+                f"median {statistics.median(timings):.2f}, "
+                f"max {max(timings):.2f} seconds"
+            )
+        else:
+            print(f"Time taken: {timings[0]:.2f} seconds")
 
-        # Query 11
-        print("Query 11:")
-        queries.query_11(trackpoint)
+    if monitor is not None:
+        if monitor.explain:
+            monitor.explain_captured(connection.client)
+        monitor.print_summary()
 
-        # Query 12
-        print("Query 12:")
-        queries.query_12(trackpoint)
+    if profiler is not None:
+        profiler.print_report()
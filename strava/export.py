@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""Code to export collections and query results to columnar files.
+
+This module contains code that streams the `user`, `activity` and
+`trackpoint` collections, or the result of a query function, to Parquet or
+Arrow IPC files in fixed-size record batches, so memory use does not grow
+with the size of the collection. Column projection and filters are pushed
+down to MongoDB. Collections can be exported in parallel across ranges of
+activity ids, with one file per range.
+
+Requires the optional `pyarrow` package.
+"""
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+# Supported file formats and their extensions
+FORMATS = {"parquet": "parquet", "ipc": "arrow"}
+
+# Field used to split each collection into activity id ranges
+RANGE_FIELDS = {"activity": "_id", "trackpoint": "activity_id"}
+
+
+def _pyarrow():
+    """Import pyarrow, which is only needed for exports."""
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError(
+            "Exporting requires pyarrow. Install it with `conda install pyarrow`."
+        )
+    return pyarrow
+
+
+def schema(name):
+    """Return the Arrow schema of a collection.
+
+    Parameters
+    ----------
+    name : str
+        The collection name, `user`, `activity`, `trackpoint` or
+        `trackpoint_simplified`.
+
+    Returns
+    -------
+    :obj:`pyarrow.Schema`
+        The schema.
+    """
+    pa = _pyarrow()
+    trackpoint = [
+        ("_id", pa.int64()),
+        ("lat", pa.float64()),
+        ("lon", pa.float64()),
+        ("altitude", pa.float64()),
+        ("date_days", pa.float64()),
+        ("date_time", pa.timestamp("ms")),
+        ("activity_id", pa.int64()),
+        ("partition", pa.int64()),
+    ]
+    schemas = {
+        "user": [
+            ("_id", pa.string()),
+            ("has_labels", pa.bool_()),
+            ("activity_id", pa.list_(pa.int64())),
+        ],
+        "activity": [
+            ("_id", pa.int64()),
+            ("start_date_time", pa.timestamp("ms")),
+            ("end_date_time", pa.timestamp("ms")),
+            ("transportation_mode", pa.string()),
+        ],
+        "trackpoint": trackpoint,
+        "trackpoint_simplified": trackpoint,
+    }
+    if name not in schemas:
+        raise ValueError(f"No export schema for collection `{name}`.")
+    return pa.schema(schemas[name])
+
+
+class _Writer:
+    """Write record batches to a Parquet or Arrow IPC file."""
+
+    def __init__(self, path, schema, fmt):
+        pa = _pyarrow()
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+
+            self._writer = pq.ParquetWriter(path, schema)
+            self._write = lambda batch: self._writer.write_table(
+                pa.Table.from_batches([batch])
+            )
+        elif fmt == "ipc":
+            self._sink = pa.OSFile(path, "wb")
+            self._writer = pa.ipc.new_file(self._sink, schema)
+            self._write = self._writer.write_batch
+        else:
+            raise ValueError(f"Unknown export format `{fmt}`.")
+        self._fmt = fmt
+
+    def write(self, batch):
+        self._write(batch)
+
+    def close(self):
+        self._writer.close()
+        if self._fmt == "ipc":
+            self._sink.close()
+
+
+def _record_batch(rows, schema):
+    """Convert a list of documents to a record batch with the given schema."""
+    pa = _pyarrow()
+    arrays = []
+    for field in schema:
+        values = [row.get(field.name) for row in rows]
+        if pa.types.is_string(field.type):
+            # Unlabeled activities have NaN as transportation mode
+            values = [v if isinstance(v, str) else None for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _export_cursor(cursor, path, schema, fmt, batch_size):
+    """Stream the documents of a cursor to a file in record batches.
+
+    Returns
+    -------
+    int
+        The number of documents written.
+    """
+    writer = _Writer(path, schema, fmt)
+    count = 0
+    try:
+        rows = []
+        for document in cursor:
+            rows.append(document)
+            if len(rows) == batch_size:
+                writer.write(_record_batch(rows, schema))
+                count += len(rows)
+                rows = []
+        if rows or count == 0:
+            writer.write(_record_batch(rows, schema))
+            count += len(rows)
+    finally:
+        writer.close()
+    return count
+
+
+def export_collection(
+    collection,
+    path,
+    fmt="parquet",
+    columns=None,
+    filter=None,
+    batch_size=65536,
+    workers=1,
+):
+    """Export a collection to Parquet or Arrow IPC files.
+
+    Parameters
+    ----------
+    collection : :obj:
+        The pymongo collection object to export.
+    path : str
+        The output file. With several workers, the output directory, which
+        receives one `part-NNNNN` file per activity id range.
+    fmt : str
+        `parquet` or `ipc`.
+    columns : list of str, optional
+        The fields to export. All fields if not given.
+    filter : dict, optional
+        MongoDB filter selecting the documents to export.
+    batch_size : int
+        Number of documents per record batch.
+    workers : int
+        Number of activity id ranges exported in parallel. Collections
+        without activity ids are exported by a single worker, to a single
+        part file in the output directory.
+
+    Returns
+    -------
+    list of str
+        The files written.
+    """
+    export_schema = schema(collection.name)
+    if columns is not None:
+        unknown = [name for name in columns if name not in export_schema.names]
+        if unknown:
+            raise ValueError(
+                f"Unknown columns {', '.join(unknown)} for collection "
+                f"`{collection.name}`. Choose from {', '.join(export_schema.names)}."
+            )
+        export_schema = _pyarrow().schema(
+            [export_schema.field(name) for name in columns]
+        )
+    projection = {name: 1 for name in export_schema.names}
+    if "_id" not in projection:
+        projection["_id"] = 0
+    filter = filter or {}
+
+    if workers <= 1:
+        cursor = collection.find(filter, projection, batch_size=batch_size)
+        _export_cursor(cursor, path, export_schema, fmt, batch_size)
+        return [path]
+
+    os.makedirs(path, exist_ok=True)
+    range_field = RANGE_FIELDS.get(collection.name.replace("_simplified", ""))
+    if range_field is None:
+        part_path = os.path.join(path, f"part-00000.{FORMATS[fmt]}")
+        cursor = collection.find(filter, projection, batch_size=batch_size)
+        _export_cursor(cursor, part_path, export_schema, fmt, batch_size)
+        return [part_path]
+
+    # Split the activity ids into one contiguous range per worker
+    first = collection.find_one(filter, {range_field: 1}, sort=[(range_field, 1)])
+    last = collection.find_one(filter, {range_field: 1}, sort=[(range_field, -1)])
+    if first is None:
+        return []
+    low, high = first[range_field], last[range_field] + 1
+    step = math.ceil((high - low) / workers)
+    ranges = [(start, min(start + step, high)) for start in range(low, high, step)]
+
+    def export_range(i, start, end):
+        range_filter = {"$and": [filter, {range_field: {"$gte": start, "$lt": end}}]}
+        part_path = os.path.join(path, f"part-{i:05d}.{FORMATS[fmt]}")
+        cursor = collection.find(range_filter, projection, batch_size=batch_size)
+        _export_cursor(cursor, part_path, export_schema, fmt, batch_size)
+        return part_path
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(export_range, i, start, end)
+            for i, (start, end) in enumerate(ranges)
+        ]
+        return [future.result() for future in futures]
+
+
+def export_result(result, path, fmt="parquet"):
+    """Export the result of a query function.
+
+    Parameters
+    ----------
+    result : list of dict or :obj:`pandas.DataFrame`
+        The result returned by a query function. Duplicate column names get a
+        numbered suffix.
+    path : str
+        The output file.
+    fmt : str
+        `parquet` or `ipc`.
+    """
+    pa = _pyarrow()
+    df = result if isinstance(result, pd.DataFrame) else pd.DataFrame(result)
+    # Arrow requires unique column names, e.g. query 7 has four `user_id`
+    # columns, which are exported as `user_id`, `user_id_1`, ...
+    seen = {}
+    names = []
+    for name in map(str, df.columns):
+        names.append(f"{name}_{seen[name]}" if name in seen else name)
+        seen[name] = seen.get(name, 0) + 1
+    df = df.set_axis(names, axis=1)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    writer = _Writer(path, table.schema, fmt)
+    try:
+        for batch in table.to_batches():
+            writer.write(batch)
+    finally:
+        writer.close()
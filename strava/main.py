@@ -5,40 +5,544 @@ TDT4225 Very Large, Distributed Data Volumes - Assignment 3.
 Author: Simen Omholt-Jensen
 
 This module contains code that runs the strava interface.
+
+Usage::
+
+    python main.py [run] [--force] [--queries 6,11] [--repeat N]
+    python main.py ingest [--force] [--simplify METERS] [--partition {year,month}]
+                          [--chunked] [--users-per-chunk N]
+                          [--profile-memory] [--memory-budget 4G]
+                          [--memory-policy {abort,chunk}]
+    python main.py query [--queries 6,11] [--repeat N] [--monitor] [--explain]
+                         [--tier {full,simplified}] [--approximate]
+    python main.py export COLLECTION PATH [--format {parquet,ipc}] [--workers N]
+                          [--columns lat,lon] [--filter JSON]
+    python main.py bench [benchmark arguments]
+
+MongoDB login information and connection options are read from the command
+line, the environment (`STRAVA_USER`, `STRAVA_PASSWORD`, `STRAVA_HOST`,
+`STRAVA_DB_NAME`, `STRAVA_POOL_SIZE`, `STRAVA_MIN_POOL_SIZE`,
+`STRAVA_COMPRESSORS`, `STRAVA_READ_PREFERENCE`, `STRAVA_TIMEOUT_MS`) or the `[mongodb]` section of an INI config file
+given by `--config`, in that order of precedence. The user and password are
+prompted for if they are not found and a terminal is attached.
 """
+import argparse
+import configparser
 import getpass
+import os
+import sys
+from bson import json_util
+import memory
 from database import insert_data
 from database import query_database
 from database import create_user
+from database import dataset_loaded
+from database import read_layout
+from connection import Connection
+
+# Default MongoDB login information and connection options
+DEFAULTS = {
+    "host": "localhost",
+    "db_name": "TDT4225ProjectGroup78",
+    "pool_size": "100",
+    "min_pool_size": "0",
+    "read_preference": "primary",
+    "timeout_ms": "30000",
+}
+
+# Subcommands
+COMMANDS = ("run", "ingest", "query", "export", "bench")
+
+
+def load_config(args):
+    """Read the `[mongodb]` section of the config file, if one is given.
+
+    Parameters
+    ----------
+    args : :obj:`argparse.Namespace`
+        The parsed command line arguments.
+
+    Returns
+    -------
+    dict
+        The config file settings.
+    """
+    if not args.config:
+        return {}
+    parser = configparser.ConfigParser()
+    if not parser.read(args.config):
+        sys.exit(f"Could not read config file `{args.config}`.")
+    if not parser.has_section("mongodb"):
+        return {}
+    return dict(parser["mongodb"])
+
+
+def resolve(args, config, key):
+    """Resolve a setting from the command line, environment or config file.
+
+    Parameters
+    ----------
+    args : :obj:`argparse.Namespace`
+        The parsed command line arguments.
+    config : dict
+        The config file settings.
+    key : str
+        The setting name.
+
+    Returns
+    -------
+    str or None
+        The setting, or its default if it is not set anywhere.
+    """
+    value = getattr(args, key, None)
+    if value is None:
+        value = os.environ.get(f"STRAVA_{key.upper()}")
+    if value is None:
+        value = config.get(key)
+    if value is None:
+        value = DEFAULTS.get(key)
+    return value
 
-def main():
-    """Set up the database and run the program.
 
-    Program prompts user for their MongoDB login information. A database called
-    `TDT4225ProjectGroup78` is created with the user login information, and
-    filled with data from the `.plt` files in the `dataset` folder. The program
-    then queries the database to answer the questions found in the assignment
-    text.
+def connect(args, monitor=None):
+    """Create the shared connection from the resolved settings.
 
+    Parameters
+    ----------
+    args : :obj:`argparse.Namespace`
+        The parsed command line arguments.
+    monitor : :obj:`monitoring.CommandMonitor`, optional
+        Command monitor to register with the client.
+
+    Returns
+    -------
+    :obj:`connection.Connection`
+        The shared connection to the database.
     """
-    # Prompt the user for their MongoDB login inforamtion
-    USER = input("Enter MongoDB user: ")
-    PASSWORD = getpass.getpass(prompt="Enter MongoDB password: ")
+    config = load_config(args)
+    USER = resolve(args, config, "user")
+    PASSWORD = resolve(args, config, "password")
+    HOST = resolve(args, config, "host")
+    DB_NAME = resolve(args, config, "db_name")
+
+    # Prompt the user for missing MongoDB login information
+    interactive = sys.stdin.isatty()
+    if USER is None:
+        if not interactive:
+            sys.exit("No MongoDB user given. Set STRAVA_USER or use --user.")
+        USER = input("Enter MongoDB user: ")
+    if PASSWORD is None:
+        if not interactive:
+            sys.exit("No MongoDB password given. Set STRAVA_PASSWORD.")
+        PASSWORD = getpass.getpass(prompt="Enter MongoDB password: ")
 
-    # Database name
-    DB_NAME = "TDT4225ProjectGroup78"
+    return Connection(
+        USER,
+        PASSWORD,
+        HOST,
+        DB_NAME,
+        max_pool_size=int(resolve(args, config, "pool_size")),
+        min_pool_size=int(resolve(args, config, "min_pool_size")),
+        compressors=resolve(args, config, "compressors"),
+        read_preference=resolve(args, config, "read_preference"),
+        timeout_ms=int(resolve(args, config, "timeout_ms")),
+        monitor=monitor,
+    )
 
-    # Host name
-    HOST = "localhost"
+
+def ingest(
+    connection,
+    force=False,
+    simplify_tolerance=None,
+    partition_granularity=None,
+    profiler=None,
+    chunked=False,
+    users_per_chunk=10,
+):
+    """Create and fill the database unless it is already loaded.
+
+    Parameters
+    ----------
+    connection : :obj:`connection.Connection`
+        The shared connection to the database.
+    force : bool
+        Drop and reload the database even if it is already loaded.
+    simplify_tolerance : float, optional
+        Tolerance in meters of the simplified trackpoint tier. The tier is not
+        built if None.
+    partition_granularity : str, optional
+        Time partitioning of the trackpoints, `year` or `month`. The
+        trackpoints are not partitioned if None.
+    profiler : :obj:`memory.MemoryProfiler`, optional
+        If given, record the memory use of each ingest stage.
+    chunked : bool
+        Parse and insert the data a few users at a time.
+    users_per_chunk : int
+        Number of users per chunk.
+    """
+    if not force and dataset_loaded(connection):
+        # The loaded dataset must have the requested layout
+        layout = read_layout(connection.db)
+        missing = []
+        if simplify_tolerance is not None and (
+            layout.get("simplify_tolerance") != simplify_tolerance
+        ):
+            missing.append(f"--simplify {simplify_tolerance:g}")
+        if partition_granularity is not None and (
+            layout.get("partition_granularity") != partition_granularity
+        ):
+            missing.append(f"--partition {partition_granularity}")
+        if missing:
+            sys.exit(
+                f"Dataset already loaded without {' and '.join(missing)}. "
+                f"Use --force to reload it with these options."
+            )
+        print("Dataset already loaded, skipping ingest. Use --force to reload.")
+        return
 
     # Create user
-    create_user(USER, PASSWORD, HOST,  DB_NAME)
+    create_user(connection)
 
     # create strava database
-    insert_data(USER, PASSWORD, HOST,  DB_NAME)
+    try:
+        insert_data(
+            connection,
+            simplify_tolerance=simplify_tolerance,
+            partition_granularity=partition_granularity,
+            profiler=profiler,
+            chunked=chunked,
+            users_per_chunk=users_per_chunk,
+        )
+    except memory.MemoryBudgetExceeded as e:
+        if profiler is not None:
+            profiler.print_report()
+        sys.exit(f"Ingest aborted: {e}")
+
+
+def query_numbers(value):
+    """Parse a comma separated list of query numbers, e.g. `6,11`."""
+    try:
+        numbers = [int(n) for n in value.split(",") if n.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid query list: {value!r}")
+    invalid = [n for n in numbers if not 1 <= n <= 12]
+    if invalid:
+        raise argparse.ArgumentTypeError(f"no such queries: {invalid}")
+    return numbers
+
+
+def error_targets(value):
+    """Parse relative error targets, e.g. `0.05` or `0.05,10=0.02`.
+
+    A bare target applies to every query, `N=TARGET` to query N only.
+    """
+    targets = {}
+    per_query = {}
+    try:
+        for part in value.split(","):
+            if "=" in part:
+                number, target = part.split("=")
+                per_query[int(number)] = float(target)
+            elif part.strip():
+                targets = dict.fromkeys(range(1, 13), float(part))
+        targets.update(per_query)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid error targets: {value!r}")
+    invalid = [n for n, target in targets.items() if not 1 <= n <= 12 or target <= 0]
+    if invalid:
+        raise argparse.ArgumentTypeError(f"invalid error targets: {value!r}")
+    return targets
+
+
+def positive_int(value):
+    """Parse a positive integer."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be positive: {value!r}")
+    return number
+
+
+def build_parser():
+    """Build the command line argument parser.
+
+    Returns
+    -------
+    :obj:`argparse.ArgumentParser`
+        The parser.
+    """
+    login = argparse.ArgumentParser(add_help=False)
+    login.add_argument("--config", help="INI file with a [mongodb] section")
+    login.add_argument("--user", help="MongoDB user (env: STRAVA_USER)")
+    login.add_argument("--host", help="MongoDB host (env: STRAVA_HOST)")
+    login.add_argument("--db-name", dest="db_name", help="(env: STRAVA_DB_NAME)")
+    login.add_argument(
+        "--pool-size", dest="pool_size", help="max pooled connections (default 100)"
+    )
+    login.add_argument(
+        "--min-pool-size",
+        dest="min_pool_size",
+        help="connections kept open in the pool (default 0)",
+    )
+    login.add_argument("--compressors", help="wire compressors, e.g. zstd,snappy")
+    login.add_argument(
+        "--read-preference", dest="read_preference", help="e.g. secondaryPreferred"
+    )
+    login.add_argument(
+        "--timeout-ms",
+        dest="timeout_ms",
+        help="server selection and connect timeout (default 30000)",
+    )
+
+    ingest_options = argparse.ArgumentParser(add_help=False)
+    ingest_options.add_argument(
+        "--force", action="store_true", help="reload even if already loaded"
+    )
+    ingest_options.add_argument(
+        "--simplify",
+        type=float,
+        metavar="METERS",
+        help="also build the simplified trackpoint tier with this tolerance",
+    )
+    ingest_options.add_argument(
+        "--partition",
+        choices=("year", "month"),
+        help="add an indexed time partition key to the trackpoints",
+    )
+    ingest_options.add_argument(
+        "--chunked",
+        action="store_true",
+        help="parse and insert a few users at a time to bound memory use",
+    )
+    ingest_options.add_argument(
+        "--users-per-chunk",
+        dest="users_per_chunk",
+        type=positive_int,
+        default=10,
+        metavar="N",
+        help="users per chunk of chunked ingest (10)",
+    )
+
+    query_options = argparse.ArgumentParser(add_help=False)
+    query_options.add_argument(
+        "--queries", type=query_numbers, help="comma separated, e.g. 6,11"
+    )
+    query_options.add_argument(
+        "--repeat", type=positive_int, default=1, help="run each query N times"
+    )
+    query_options.add_argument(
+        "--monitor", action="store_true", help="print a command summary"
+    )
+    query_options.add_argument(
+        "--explain", action="store_true", help="also explain the pipelines"
+    )
+    query_options.add_argument("--cache", metavar="DIR", help="result cache dir")
+    query_options.add_argument(
+        "--tier",
+        choices=("full", "simplified"),
+        default="full",
+        help="trackpoint tier for the spatial queries",
+    )
+    query_options.add_argument(
+        "--approximate",
+        action="store_true",
+        help="answer queries 1, 4, 8 and 10 approximately",
+    )
+    query_options.add_argument(
+        "--export", metavar="DIR", help="export each query result to DIR"
+    )
+    query_options.add_argument(
+        "--export-format", choices=("parquet", "ipc"), default="parquet"
+    )
+    query_options.add_argument(
+        "--no-rollups",
+        dest="use_rollups",
+        action="store_false",
+        help="scan user and activity instead of reading the rollups",
+    )
+    query_options.add_argument(
+        "--error",
+        type=error_targets,
+        default="0.05",
+        help="relative error targets, per query as in 0.05,10=0.02 (0.05)",
+    )
+    query_options.add_argument(
+        "--confidence", type=float, default=0.95, help="confidence level (0.95)"
+    )
+
+    memory_options = argparse.ArgumentParser(add_help=False)
+    memory_options.add_argument(
+        "--profile-memory",
+        dest="profile_memory",
+        action="store_true",
+        help="print the peak memory and top allocation sites per stage",
+    )
+    memory_options.add_argument(
+        "--memory-budget",
+        dest="memory_budget",
+        type=memory.parse_size,
+        metavar="SIZE",
+        help="maximum resident set size, e.g. 4G",
+    )
+    memory_options.add_argument(
+        "--memory-policy",
+        dest="memory_policy",
+        choices=("abort", "chunk"),
+        default="abort",
+        help="abort the stage, or fall back to chunked ingest, over budget",
+    )
+
+    parser = argparse.ArgumentParser(
+        description="TDT4225 Assignment 3 strava interface."
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser(
+        "run",
+        parents=[login, ingest_options, query_options, memory_options],
+        help="ingest (unless loaded) and query, the default",
+    )
+    subparsers.add_parser(
+        "ingest",
+        parents=[login, ingest_options, memory_options],
+        help="create and fill the database",
+    )
+    subparsers.add_parser(
+        "query", parents=[login, query_options, memory_options], help="run queries"
+    )
+    export_parser = subparsers.add_parser(
+        "export", parents=[login], help="export a collection to Parquet or Arrow"
+    )
+    export_parser.add_argument("collection", help="e.g. trackpoint")
+    export_parser.add_argument("path", help="output file, or directory if --workers")
+    export_parser.add_argument(
+        "--format", dest="export_format", choices=("parquet", "ipc"), default="parquet"
+    )
+    export_parser.add_argument(
+        "--columns", type=lambda s: s.split(","), help="e.g. lat,lon,date_time"
+    )
+    export_parser.add_argument(
+        "--filter",
+        type=json_util.loads,
+        help='MongoDB extended JSON, e.g. \'{"activity_id": {"$lt": 100}}\'',
+    )
+    export_parser.add_argument("--batch-size", type=positive_int, default=65536)
+    export_parser.add_argument(
+        "--workers", type=positive_int, default=1, help="parallel activity id ranges"
+    )
+    # Arguments of `bench` are passed on to `benchmark.main` unparsed
+    subparsers.add_parser("bench", add_help=False, help="run the benchmark suite")
+    return parser
+
+
+def main(argv=None):
+    """Set up the database and run the program.
+
+    A database called `TDT4225ProjectGroup78` is created with the user login
+    information, and filled with data from the `.plt` files in the `dataset`
+    folder, unless it has already been filled. The program then queries the
+    database to answer the questions found in the assignment text.
+
+    Parameters
+    ----------
+    argv : list of str, optional
+        The command line arguments. `sys.argv` if not given.
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] == "bench":
+        import benchmark
+
+        benchmark.main(argv[1:])
+        return
+
+    # Default to the `run` command
+    if not argv or argv[0] not in COMMANDS + ("-h", "--help"):
+        argv = ["run"] + argv
+    args = build_parser().parse_args(argv)
+    command = args.command
+
+    monitor = None
+    if command in ("run", "query") and (args.monitor or args.explain):
+        from monitoring import CommandMonitor
+
+        monitor = CommandMonitor(explain=args.explain)
+
+    profiler = None
+    if command in ("run", "ingest", "query"):
+        try:
+            memory.set_budget(args.memory_budget, args.memory_policy)
+        except RuntimeError as e:
+            sys.exit(str(e))
+        if args.profile_memory:
+            profiler = memory.MemoryProfiler()
+
+    with connect(args, monitor) as connection:
+        if command in ("run", "ingest"):
+            ingest(
+                connection,
+                force=args.force,
+                simplify_tolerance=args.simplify,
+                partition_granularity=args.partition,
+                profiler=profiler,
+                chunked=args.chunked,
+                users_per_chunk=args.users_per_chunk,
+            )
+            # With `run`, the report is printed after the queries
+            if command == "ingest" and profiler is not None:
+                profiler.print_report()
+
+        if command in ("run", "query"):
+            cache = None
+            if args.cache:
+                from cache import ResultCache
+
+                cache = ResultCache(args.cache)
+
+            if not dataset_loaded(connection):
+                sys.exit(
+                    "Dataset not loaded, or its ingest did not complete. "
+                    "Run `python main.py ingest` first."
+                )
+            if args.tier == "simplified" and (
+                "simplify_tolerance" not in read_layout(connection.db)
+            ):
+                sys.exit(
+                    "The simplified trackpoint tier was not built at ingest. "
+                    "Use ingest --force --simplify METERS to build it."
+                )
+
+            # Perform queries
+            query_database(
+                connection,
+                query_numbers=args.queries,
+                repeat=args.repeat,
+                cache=cache,
+                tier=args.tier,
+                mode="approximate" if args.approximate else "exact",
+                error=args.error,
+                confidence=args.confidence,
+                use_rollups=args.use_rollups,
+                export_dir=args.export,
+                export_format=args.export_format,
+                profiler=profiler,
+            )
+
+        if command == "export":
+            import export
+
+            try:
+                paths = export.export_collection(
+                    connection.db[args.collection],
+                    args.path,
+                    fmt=args.export_format,
+                    columns=args.columns,
+                    filter=args.filter,
+                    batch_size=args.batch_size,
+                    workers=args.workers,
+                )
+            except ValueError as e:
+                # Unknown collection or columns
+                sys.exit(str(e))
+            print(f"Exported {args.collection} to {len(paths)} file(s).")
 
-    # Perform queries
-    query_database(USER, PASSWORD, HOST,  DB_NAME)
 
 if __name__ == "__main__":
     main()
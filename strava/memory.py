@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""Code to profile and bound the memory use of parsing, ingest and queries.
+
+This module contains an opt-in memory profiler that records, for each stage
+(e.g. `parse_data` or `query_6`), the peak memory traced by `tracemalloc`, the
+peak resident set size sampled by a background thread, and the allocation
+sites that grew the most during the stage.
+
+It also contains a process wide memory budget. Long running loops call
+`checkpoint`, which raises `MemoryBudgetExceeded` once the resident set size
+exceeds the budget, so the caller can abort or switch to a chunked path
+before the machine runs out of memory. Within `relative_budget`, the budget
+applies to the growth of the resident set size instead, so a chunked path can
+meet it even if memory freed by an aborted attempt is not returned to the
+operating system. The budget needs the current resident set size, read from
+`/proc` or with `psutil`.
+"""
+import contextlib
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from tabulate import tabulate
+
+# Process wide memory budget in bytes, and what to do when it is exceeded
+_budget = None
+_policy = "abort"
+# Resident set size the budget is relative to, see `relative_budget`
+_baseline = 0
+
+# Suffixes accepted by `parse_size`
+_UNITS = {"": 1, "K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """Raised by `checkpoint` when the resident set size exceeds the budget."""
+
+
+def current_rss():
+    """Return the current resident set size of the process in bytes.
+
+    Returns
+    -------
+    int or None
+        The resident set size, or None if it can not be read.
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def max_rss():
+    """Return the high-water mark of the resident set size in bytes.
+
+    Returns
+    -------
+    int
+        The peak resident set size of the process.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def parse_size(value):
+    """Parse a size such as `512M` or `4G` into bytes.
+
+    Parameters
+    ----------
+    value : str
+        The size, with an optional K, M, G or T suffix (powers of 1024).
+
+    Returns
+    -------
+    int
+        The size in bytes.
+    """
+    value = value.strip().upper().rstrip("B")
+    unit = value[-1:] if value[-1:] in _UNITS else ""
+    number = value[: len(value) - len(unit)]
+    return int(float(number) * _UNITS[unit])
+
+
+def set_budget(limit, policy="abort"):
+    """Set the process wide memory budget.
+
+    Parameters
+    ----------
+    limit : int or None
+        Maximum resident set size in bytes. No budget if None.
+    policy : str
+        `abort` to abort the stage exceeding the budget, or `chunk` to let
+        stages that have one switch to a chunked path.
+    """
+    global _budget, _policy
+    if policy not in ("abort", "chunk"):
+        raise ValueError(f"Unknown memory budget policy `{policy}`.")
+    if limit is not None and current_rss() is None:
+        # The high-water mark of `getrusage` never decreases, so it can not be
+        # used to check a budget
+        raise RuntimeError(
+            "A memory budget needs the current resident set size, which can "
+            "not be read on this platform. Install psutil."
+        )
+    _budget = limit
+    _policy = policy
+
+
+def budget_policy():
+    """Return the policy of the memory budget, `abort` or `chunk`."""
+    return _policy
+
+
+@contextlib.contextmanager
+def relative_budget():
+    """Apply the memory budget to the growth of the resident set size.
+
+    Within the context, `checkpoint` compares the growth of the resident set
+    size since entering the context with the budget.
+    """
+    global _baseline
+    previous = _baseline
+    _baseline = current_rss() or 0
+    try:
+        yield
+    finally:
+        _baseline = previous
+
+
+def checkpoint():
+    """Raise `MemoryBudgetExceeded` if the memory budget is exceeded.
+
+    Cheap enough to call once per file or per loop iteration.
+    """
+    if _budget is None:
+        return
+    rss = current_rss()
+    if rss is None:
+        return
+    if rss - _baseline > _budget:
+        if _baseline:
+            usage = f"Resident set size growth {(rss - _baseline) / 2 ** 20:.0f} MiB"
+        else:
+            usage = f"Resident set size {rss / 2 ** 20:.0f} MiB"
+        raise MemoryBudgetExceeded(
+            f"{usage} exceeds the memory budget of {_budget / 2 ** 20:.0f} MiB."
+        )
+
+
+class PeakRSS:
+    """Context manager sampling the peak resident set size of the process.
+
+    A background thread samples the resident set size at a fixed interval.
+    If the current resident set size can not be read on the platform, the
+    high-water mark of the process reported by `getrusage` is used instead.
+
+    Parameters
+    ----------
+    interval : float
+        Seconds between samples.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.start = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start = self.peak = self._read()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._read())
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._read())
+
+    @staticmethod
+    def _read():
+        rss = current_rss()
+        return rss if rss is not None else max_rss()
+
+
+class MemoryProfiler:
+    """Record the memory use of named stages.
+
+    Parameters
+    ----------
+    top : int
+        Number of allocation sites to report per stage.
+    interval : float
+        Seconds between resident set size samples.
+    """
+
+    def __init__(self, top=5, interval=0.05):
+        self.top = top
+        self.interval = interval
+        self.stages = []
+        # Peak traced memory of each active stage, innermost last
+        self._peaks = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Profile the memory use of the code run within the context.
+
+        The allocation sites are those that grew the most between the start
+        and the end of the stage, i.e. what the stage left allocated. Stages
+        may be nested, e.g. `concat` within `parse_data`.
+
+        Parameters
+        ----------
+        name : str
+            The stage name, e.g. `parse_data`.
+        """
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        # Resetting the peak would lose the peak of an enclosing stage so far
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+        self._peaks.append(0)
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        start_time = time.time()
+        record = {"stage": name, "aborted": False}
+        self.stages.append(record)
+        try:
+            with PeakRSS(self.interval) as rss:
+                yield
+        except MemoryBudgetExceeded:
+            record["aborted"] = True
+            raise
+        finally:
+            record["time"] = time.time() - start_time
+            record["peak_traced"] = max(
+                self._peaks.pop(), tracemalloc.get_traced_memory()[1]
+            )
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], record["peak_traced"])
+            record["peak_rss"] = rss.peak
+            record["rss_growth"] = rss.peak - rss.start
+            after = tracemalloc.take_snapshot()
+            # Ignore the allocations of the profiler and its sampling thread
+            filters = [
+                tracemalloc.Filter(False, module.__file__)
+                for module in (tracemalloc, threading, sys.modules[__name__])
+            ]
+            stats = after.filter_traces(filters).compare_to(
+                before.filter_traces(filters), "lineno"
+            )
+            record["top"] = [
+                (str(stat.traceback[0]), stat.size_diff)
+                for stat in stats[: self.top]
+                if stat.size_diff > 0
+            ]
+            del before, after, stats
+            if started:
+                tracemalloc.stop()
+
+    def print_report(self):
+        """Print the peak memory and top allocation sites of each stage."""
+        rows = [
+            [
+                record["stage"],
+                record["time"],
+                record["peak_traced"] / 2 ** 20,
+                record["peak_rss"] / 2 ** 20,
+                record["rss_growth"] / 2 ** 20,
+                "yes" if record["aborted"] else "",
+            ]
+            for record in self.stages
+        ]
+        headers = [
+            "stage",
+            "time (s)",
+            "peak traced (MiB)",
+            "peak RSS (MiB)",
+            "RSS growth (MiB)",
+            "aborted",
+        ]
+        print(tabulate(rows, headers=headers, floatfmt=".1f", tablefmt="orgtbl"))
+        for record in self.stages:
+            if not record["top"]:
+                continue
+            print(f"Top allocation sites of {record['stage']}:")
+            for site, size in record["top"]:
+                print(f"  {size / 2 ** 20:8.1f} MiB  {site}")
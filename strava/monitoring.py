@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""Code to instrument the commands sent to the `TDT4225ProjectGroup78` database.
+
+This module contains a pymongo command listener that records the duration,
+the size of the reply and the number of `getMore` round trips of every command
+sent while a label (e.g. `Query 6`) is active. Optionally, the `aggregate` and
+`find` commands are captured and replayed with `explain` at the
+`executionStats` verbosity, to report the documents examined, the indexes used
+and whether any stage spilled to disk. A summary table is printed per label.
+"""
+import contextlib
+import threading
+import time
+import bson
+from pymongo import monitoring
+from pymongo.errors import OperationFailure
+from tabulate import tabulate
+
+# Command fields that are kept when a captured command is replayed by explain
+_EXPLAIN_FIELDS = {
+    "aggregate": ("aggregate", "pipeline", "allowDiskUse", "collation", "let"),
+    "find": (
+        "find",
+        "filter",
+        "projection",
+        "sort",
+        "skip",
+        "limit",
+        "hint",
+        "collation",
+    ),
+}
+
+
+class CommandMonitor(monitoring.CommandListener):
+    """Record pymongo command events grouped by label.
+
+    Register the monitor with `MongoClient(..., event_listeners=[monitor])`,
+    and wrap the code to instrument in `monitor.label(...)`. Commands sent
+    outside a label are ignored.
+
+    Parameters
+    ----------
+    explain : bool
+        Whether to capture `aggregate` and `find` commands so they can be
+        replayed with `explain` by `explain_captured`.
+    """
+
+    def __init__(self, explain=False):
+        self.explain = explain
+        self.commands = []
+        self.explained = []
+        self._label = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def label(self, name):
+        """Attribute the commands sent within the context to `name`.
+
+        Parameters
+        ----------
+        name : str
+            The label, e.g. `Query 6`.
+        """
+        previous, self._label = self._label, name
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._label = previous
+            with self._lock:
+                self.commands.append(
+                    {
+                        "label": name,
+                        "command_name": None,
+                        "duration": time.perf_counter() - start_time,
+                    }
+                )
+
+    def started(self, event):
+        if self._label is None:
+            return
+        command = None
+        if self.explain and event.command_name in _EXPLAIN_FIELDS:
+            fields = _EXPLAIN_FIELDS[event.command_name]
+            command = {k: event.command[k] for k in fields if k in event.command}
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = (
+                self._label,
+                event.database_name,
+                command,
+            )
+
+    def succeeded(self, event):
+        self._finish(event, event.reply)
+
+    def failed(self, event):
+        self._finish(event, event.failure)
+
+    def _finish(self, event, reply):
+        with self._lock:
+            pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return
+        label, database_name, command = pending
+        try:
+            reply_bytes = len(bson.encode(reply))
+        except Exception:
+            reply_bytes = 0
+        with self._lock:
+            self.commands.append(
+                {
+                    "label": label,
+                    "command_name": event.command_name,
+                    "duration": event.duration_micros / 1e6,
+                    "reply_bytes": reply_bytes,
+                    "database_name": database_name,
+                    "command": command,
+                }
+            )
+
+    def explain_captured(self, client):
+        """Replay the captured commands with `explain("executionStats")`.
+
+        Identical commands of the same label, e.g. from repeated runs of a
+        query, are explained once. Commands that can not be explained are
+        reported and skipped.
+
+        Parameters
+        ----------
+        client : :obj:
+            The pymongo client to run the explain commands on. Commands sent by
+            this method are not recorded.
+        """
+        explained = set()
+        for record in list(self.commands):
+            if record.get("command") is None:
+                continue
+            # Repeated runs of a query send the same commands, explain them once
+            key = (
+                record["label"],
+                record["database_name"],
+                bson.encode(record["command"]),
+            )
+            if key in explained:
+                continue
+            explained.add(key)
+            db = client[record["database_name"]]
+            try:
+                plan = db.command(
+                    "explain", record["command"], verbosity="executionStats"
+                )
+            except OperationFailure as e:
+                print(
+                    f"Could not explain {record['command_name']} of "
+                    f"{record['label']}: {e}"
+                )
+                continue
+            stats = explain_stats(plan)
+            stats["label"] = record["label"]
+            stats["command_name"] = record["command_name"]
+            self.explained.append(stats)
+
+    def summary(self):
+        """Summarise the recorded commands per label.
+
+        Returns
+        -------
+        list of dict
+            One row per label, in the order the labels were first used.
+        """
+        rows = {}
+        for record in self.commands:
+            row = rows.setdefault(
+                record["label"],
+                {
+                    "label": record["label"],
+                    "wall_time": 0.0,
+                    "commands": 0,
+                    "server_time": 0.0,
+                    "reply_bytes": 0,
+                    "getmores": 0,
+                    "docs_examined": None,
+                    "indexes": None,
+                    "spilled": None,
+                },
+            )
+            if record["command_name"] is None:
+                row["wall_time"] += record["duration"]
+                continue
+            row["commands"] += 1
+            row["server_time"] += record["duration"]
+            row["reply_bytes"] += record["reply_bytes"]
+            row["getmores"] += record["command_name"] == "getMore"
+
+        for stats in self.explained:
+            row = rows[stats["label"]]
+            row["docs_examined"] = (row["docs_examined"] or 0) + stats[
+                "docs_examined"
+            ]
+            row["indexes"] = sorted(set(row["indexes"] or []) | set(stats["indexes"]))
+            row["spilled"] = bool(row["spilled"]) or stats["spilled"]
+        return list(rows.values())
+
+    def print_summary(self):
+        """Print the summary of the recorded commands as a table."""
+        rows = []
+        for row in self.summary():
+            indexes = row["indexes"]
+            if indexes is not None:
+                indexes = ", ".join(indexes) if indexes else "COLLSCAN"
+            rows.append(
+                [
+                    row["label"],
+                    row["wall_time"],
+                    row["commands"],
+                    row["server_time"],
+                    row["reply_bytes"] / 2 ** 10,
+                    row["getmores"],
+                    row["docs_examined"],
+                    indexes,
+                    row["spilled"],
+                ]
+            )
+        headers = [
+            "label",
+            "wall (s)",
+            "commands",
+            "command (s)",
+            "returned (KiB)",
+            "getMores",
+            "docs examined",
+            "index used",
+            "spilled",
+        ]
+        print(
+            tabulate(
+                rows,
+                headers=headers,
+                floatfmt=".3f",
+                missingval="-",
+                tablefmt="orgtbl",
+            )
+        )
+
+
+def explain_stats(plan):
+    """Extract the interesting statistics from an explain result.
+
+    The explain output differs between `find`, pipelines pushed down to the
+    query engine and pipelines with separate stages, so the result is searched
+    recursively.
+
+    Parameters
+    ----------
+    plan : dict
+        The result of an `explain` command at `executionStats` verbosity.
+
+    Returns
+    -------
+    dict
+        The number of documents examined, the names of the indexes used and
+        whether any stage spilled to disk.
+    """
+    stats = {"docs_examined": 0, "indexes": set(), "spilled": False}
+
+    def walk(node):
+        if isinstance(node, dict):
+            if node.get("stage") == "IXSCAN" and "indexName" in node:
+                stats["indexes"].add(node["indexName"])
+            for key, value in node.items():
+                if key == "totalDocsExamined" and isinstance(value, int):
+                    stats["docs_examined"] += value
+                elif key == "usedDisk" and value:
+                    stats["spilled"] = True
+                elif key == "spills" and isinstance(value, int) and value > 0:
+                    stats["spilled"] = True
+                else:
+                    walk(value)
+        elif isinstance(node, list):
+            for item in node:
+                walk(item)
+
+    walk(plan)
+    stats["indexes"] = sorted(stats["indexes"])
+    return stats
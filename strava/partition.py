@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Code to partition the trackpoints by time.
+
+This module contains code that adds a `partition` key (the year, or the year
+and month as `YYYYMM`) to each trackpoint at ingest, and a helper that turns a
+time range into a filter on that key. The key is indexed together with
+`activity_id`, so queries bounded by year or month only scan the index range
+of the relevant partitions instead of evaluating every trackpoint.
+"""
+import datetime
+
+# Supported partition granularities
+GRANULARITIES = ("year", "month")
+
+
+def partition_key(date, granularity):
+    """Return the partition key of a date.
+
+    Parameters
+    ----------
+    date : :obj:`datetime.datetime`
+        The date.
+    granularity : str
+        `year` or `month`.
+
+    Returns
+    -------
+    int
+        The year, or the year and month as `YYYYMM`.
+    """
+    if granularity == "year":
+        return date.year
+    if granularity == "month":
+        return date.year * 100 + date.month
+    raise ValueError(f"Unknown partition granularity `{granularity}`.")
+
+
+def add_partition_keys(trackpoint_dict, granularity):
+    """Add the partition key to each trackpoint.
+
+    Parameters
+    ----------
+    trackpoint_dict : list of dict
+        Collection of trackpoints. Modified in place.
+    granularity : str
+        `year` or `month`.
+    """
+    for trackpoint in trackpoint_dict:
+        trackpoint["partition"] = partition_key(trackpoint["date_time"], granularity)
+
+
+def create_partition_index(collection):
+    """Index the partition key of a trackpoint collection."""
+    collection.create_index([("partition", 1), ("activity_id", 1)])
+
+
+def partition_filter(granularity, start, end):
+    """Return a filter selecting the trackpoints in a time range.
+
+    Parameters
+    ----------
+    granularity : str or None
+        The partition granularity of the trackpoints, or None if they are not
+        partitioned.
+    start : :obj:`datetime.datetime`
+        Start of the range, inclusive.
+    end : :obj:`datetime.datetime`
+        End of the range, exclusive.
+
+    Returns
+    -------
+    dict
+        The filter on `date_time`, and on `partition` to prune the partitions
+        outside the range if the trackpoints are partitioned.
+    """
+    time_filter = {"date_time": {"$gte": start, "$lt": end}}
+    if granularity is None:
+        return time_filter
+    last = end - datetime.timedelta(microseconds=1)
+    time_filter["partition"] = {
+        "$gte": partition_key(start, granularity),
+        "$lte": partition_key(last, granularity),
+    }
+    return time_filter
@@ -2,8 +2,9 @@
 """Code to perform queries on the `TDT4225ProjectGroup78` MongoDB database.
 
 This module contains code that queries the `TDT4225ProjectGroup78` MongoDB
-database, to answer the questions given in the assignment text. The results are
-then printed to the console.
+database, to answer the questions given in the assignment text. The query
+functions return their results, which are printed to the console with
+`print_result`.
 """
 import pandas as pd
 import numpy as np
@@ -11,12 +12,15 @@ from haversine import haversine_vector, Unit
 from tabulate import tabulate
 from sklearn.cluster import DBSCAN
 import pprint
+import datetime
+import partition
+import memory
 
 
 def query_1(user, activity, trackpoint):
     """Find answers to question 1 by MongoDB queries.
 
-    Results are printed to the console.
+    Results are returned as a list with one document per collection.
 
     Parameters
     ----------
@@ -26,15 +30,16 @@ def query_1(user, activity, trackpoint):
         The pymongo collection object for activity.
     trackpoint : :obj:
         The pymongo collection object for trackpoint.
+
+    Returns
+    -------
+    list of dict
+        The resulting documents.
     """
-    pprint.pprint(
-        list(
-            user.aggregate(
-                [{"$group": {"_id": "Users", "NumberOfUsers": {"$count": {}}}}]
-            )
-        )
+    result = list(
+        user.aggregate([{"$group": {"_id": "Users", "NumberOfUsers": {"$count": {}}}}])
     )
-    pprint.pprint(
+    result.extend(
         list(
             activity.aggregate(
                 [
@@ -48,7 +53,7 @@ def query_1(user, activity, trackpoint):
             )
         )
     )
-    pprint.pprint(
+    result.extend(
         list(
             trackpoint.aggregate(
                 [
@@ -62,16 +67,22 @@ def query_1(user, activity, trackpoint):
             )
         )
     )
+    return result
 
 def query_2(user):
     """Find answers to question 2 by MongoDB queries.
 
-    Results are printed to the console.
+    Results are returned as a list of documents.
 
     Parameters
     ----------
     user : :obj:
         The pymongo collection object for user.
+
+    Returns
+    -------
+    list of dict
+        The resulting documents.
     """
     query = [
         {
@@ -83,17 +94,22 @@ def query_2(user):
             }
         }
     ]
-    pprint.pprint(list(user.aggregate(query)))
+    return list(user.aggregate(query))
 
 def query_3(user):
     """Find answers to question 3 by MongoDB queries.
 
-    Results are printed to the console.
+    Results are returned as a list of documents.
 
     Parameters
     ----------
     user : :obj:
         The pymongo collection object for user.
+
+    Returns
+    -------
+    list of dict
+        The resulting documents.
     """
     query = [
         {"$unwind": "$activity_id"},
@@ -101,17 +117,22 @@ def query_3(user):
         {"$sort": {"NumberOfActivities": -1}},
         {"$limit": 10},
     ]
-    pprint.pprint(list(user.aggregate(query)))
+    return list(user.aggregate(query))
 
 def query_4(activity):
     """Find answers to question 4 by MongoDB queries.
 
-    Results are printed to the console.
+    Results are returned as a list of documents.
 
     Parameters
     ----------
     activity : :obj:
         The pymongo collection object for activity.
+
+    Returns
+    -------
+    list of dict
+        The resulting documents.
     """
     query = [
         {
@@ -142,17 +163,22 @@ def query_4(activity):
             }
         },
     ]
-    pprint.pprint(list(activity.aggregate(query)))
+    return list(activity.aggregate(query))
 
 def query_5(activity):
     """Find answers to question 5 by MongoDB queries.
 
-    Results are printed to the console.
+    Results are returned as a list of documents.
 
     Parameters
     ----------
     activity : :obj:
         The pymongo collection object for activity.
+
+    Returns
+    -------
+    list of dict
+        The resulting documents.
     """
     query = [
         {
@@ -176,21 +202,26 @@ def query_5(activity):
         },
         {"$match": {"count": {"$gt": 1}}},
     ]
-    pprint.pprint(list(activity.aggregate(query)))
+    return list(activity.aggregate(query))
 
 def query_6(user, trackpoint):
     """Find answers to question 6 by MongoDB queries.
 
-    Results are printed to the console. Use DBSCAN to first cluster on users
-    close in time. Then use DBSCAN again to cluster the results on users that
-    are close in space.
+    Use DBSCAN to first cluster on users close in time. Then use DBSCAN again
+    to cluster the results on users that are close in space.
 
     Parameters
     ----------
     user : :obj:
         The pymongo collection object for user.
     trackpoint : :obj:
-        The pymongo collection object for trackpoint.
+        The pymongo collection object for trackpoint, or for the simplified
+        trackpoint tier.
+
+    Returns
+    -------
+    list of dict
+        A document with the number of close users.
     """
     # Get data from user collection
     user_result = list(user.find({}, {"has_labels": 0}))
@@ -208,6 +239,7 @@ def query_6(user, trackpoint):
     query_df = pd.merge(
         left=user_df, right=trackpoint_df, on="activity_id", how="right"
     )
+    memory.checkpoint()
 
     # Use DBSCAN to cluster on time
     X = (
@@ -222,6 +254,7 @@ def query_6(user, trackpoint):
     # Use DBSCAN again to cluster on distance using the haversine distance
     close_users = []
     for time_cluster in query_df["time_labels"].unique():
+        memory.checkpoint()
         df = query_df.loc[
             query_df["time_labels"] == time_cluster,
             ["user_id", "activity_id", "lat", "lon"],
@@ -248,12 +281,12 @@ def query_6(user, trackpoint):
     close_users = {s for arr in close_users if arr.size > 1 for s in arr}
     # Find total number of users that have been close
     number_of_close_users = len([user for s in close_users for user in s])
-    print(f"Number of close users: {number_of_close_users}")
+    return [{"_id": "CloseUsers", "NumberOfCloseUsers": number_of_close_users}]
 
 def query_7(user, activity):
     """Find answers to question 7 by MongoDB queries.
 
-    Results are printed to the console.
+    Results are returned as a table of user ids in four columns.
 
     Parameters
     ----------
@@ -261,6 +294,11 @@ def query_7(user, activity):
         The pymongo collection object for user.
     activity : :obj:
         The pymongo collection object for activity.
+
+    Returns
+    -------
+    :obj:`pandas.DataFrame`
+        The users who have never taken a taxi.
     """
     # Find all users who have taken a taxi
     query = [
@@ -286,18 +324,22 @@ def query_7(user, activity):
     # Reformat for printing purposes
     values = np.array(user_id_not_taxi).reshape((-1, 4), order="F")
     cols = ["user_id"] * 4
-    query_df = pd.DataFrame(data=values, columns=cols)
-    print(tabulate(query_df, headers="keys", showindex=False, tablefmt="orgtbl"))
+    return pd.DataFrame(data=values, columns=cols)
 
 def query_8(activity):
     """Find answers to question 8 by MongoDB queries.
 
-    Results are printed to the console.
+    Results are returned as a list of documents.
 
     Parameters
     ----------
     activity : :obj:
         The pymongo collection object for activity.
+
+    Returns
+    -------
+    list of dict
+        The resulting documents.
     """
     query = [
         {
@@ -317,13 +359,13 @@ def query_8(activity):
         {"$match": {"_id": {"$ne": np.nan}}},
         {"$project": {"_id": "$_id", "myCount": {"$size": "$user_ids"}}},
     ]
-    pprint.pprint(list(activity.aggregate(query)))
+    return list(activity.aggregate(query))
 
 def query_9(user, activity):
     """Find answers to question 9 by MongoDB queries.
 
-    Results are printed to the console. Use Pandas DataFrames to manipulate
-    the data in order to find the relevant results.
+    Use Pandas DataFrames to manipulate the data in order to find the
+    relevant results.
 
     Parameters
     ----------
@@ -331,6 +373,12 @@ def query_9(user, activity):
         The pymongo collection object for user.
     activity : :obj:
         The pymongo collection object for activity.
+
+    Returns
+    -------
+    :obj:`pandas.DataFrame`
+        The number of activities and recorded hours of the two most active
+        users in the most active year-month.
     """
     # Get data from user collection
     user_result = list(user.find({}, {"has_labels": 0}))
@@ -397,68 +445,111 @@ def query_9(user, activity):
     d = {user_ma_1: num_act_1, user_ma_2: num_act_2}
     result_df["number_of_activities"] = result_df["user_id"].map(d)
     result_df["year_month"] = year_month_ma
-    print(tabulate(result_df, headers="keys", showindex=False, tablefmt="orgtbl"))
+    return result_df
 
-def query_10(user, activity, trackpoint):
-    """Find answers to question 1 by MongoDB queries.
+def walked_distances(trackpoint, activity_ids, partition_granularity=None):
+    """Sum the distance of each activity within 2008 for question 10.
 
-    Results are printed to the console. Use Pandas DataFrames to sum the
-    distance using the haversine Python package.
+    Use Pandas DataFrames to sum the distance using the haversine Python
+    package.
 
     Parameters
     ----------
-    user : :obj:
-        The pymongo collection object for user.
-    activity : :obj:
-        The pymongo collection object for activity.
     trackpoint : :obj:
-        The pymongo collection object for trackpoint.
-
+        The pymongo collection object for trackpoint, or for the simplified
+        trackpoint tier.
+    activity_ids : list of int
+        The activities.
+    partition_granularity : str, optional
+        The partition granularity of the trackpoints, used to prune
+        partitions outside 2008. None if they are not partitioned.
+
+    Returns
+    -------
+    dict
+        The distance in kilometers keyed on activity id. Activities without
+        trackpoints in 2008 have distance 0.
     """
-    # Application side join to find relevant activities
-    user = user.find_one({"_id": "112"})
-    activities = activity.find(
-        {"_id": {"$in": user["activity_id"]}, "transportation_mode": "walk"}
+    # Query trackpoint collection for relevant trackpoints. Filter on a
+    # date_time range rather than a computed year, so indexes can be used.
+    time_filter = partition.partition_filter(
+        partition_granularity,
+        datetime.datetime(2008, 1, 1),
+        datetime.datetime(2009, 1, 1),
     )
-    activity_ids = [item["_id"] for item in list(activities)]
-    # Query trackpoint collection for relevant trackpoints
     trackpoints = trackpoint.aggregate(
         [
-            {"$match": {"activity_id": {"$in": activity_ids}}},
-            {
-                "$project": {
-                    "lat": "$lat",
-                    "lon": "$lon",
-                    "activity_id": "$activity_id",
-                    "year": {"$year": "$date_time"},
-                }
-            },
-            {"$match": {"year": 2008}},
+            {"$match": {"activity_id": {"$in": activity_ids}, **time_filter}},
+            {"$sort": {"_id": 1}},
+            {"$project": {"lat": "$lat", "lon": "$lon", "activity_id": "$activity_id"}},
         ]
     )
     query_df = pd.DataFrame(list(trackpoints))
+    memory.checkpoint()
 
-    # Use the haversine Python package to get the total distance walked.
-    distance_walked = 0
+    # Use the haversine Python package to get the distance of each activity
+    distances = dict.fromkeys(activity_ids, 0.0)
+    if len(query_df) == 0:
+        return distances
     for aid in query_df["activity_id"].unique():
+        memory.checkpoint()
         df = query_df.loc[query_df["activity_id"] == aid].copy()
         df["dist"] = haversine_vector(
             df[["lat", "lon"]].values,
             df[["lat", "lon"]].shift().values,
             Unit.KILOMETERS,
         )
-        distance_walked += df["dist"].sum()
-    print(f"Total distance walked: {distance_walked}")
+        distances[aid] = df["dist"].sum()
+    return distances
+
+
+def query_10(user, activity, trackpoint, partition_granularity=None):
+    """Find answers to question 1 by MongoDB queries.
+
+    The distances are summed by `walked_distances`.
+
+    Parameters
+    ----------
+    user : :obj:
+        The pymongo collection object for user.
+    activity : :obj:
+        The pymongo collection object for activity.
+    trackpoint : :obj:
+        The pymongo collection object for trackpoint, or for the simplified
+        trackpoint tier.
+    partition_granularity : str, optional
+        The partition granularity of the trackpoints, `year` or `month`, used
+        to prune partitions outside 2008. None if they are not partitioned.
+
+    Returns
+    -------
+    list of dict
+        A document with the total distance walked in kilometers.
+    """
+    # Application side join to find relevant activities
+    user = user.find_one({"_id": "112"})
+    activities = activity.find(
+        {"_id": {"$in": user["activity_id"]}, "transportation_mode": "walk"}
+    )
+    activity_ids = [item["_id"] for item in list(activities)]
+    distances = walked_distances(trackpoint, activity_ids, partition_granularity)
+    distance_walked = sum(distances.values())
+    return [{"_id": "DistanceWalked", "Kilometers": distance_walked}]
 
 def query_11(trackpoint):
     """Find answers to question 11 by MongoDB queries.
 
-    Results are printed to the console.
+    Results are returned as a list of documents.
 
     Parameters
     ----------
     trackpoint : :obj:
         The pymongo collection object for trackpoint.
+
+    Returns
+    -------
+    list of dict
+        The resulting documents.
     """
     query = [
         {
@@ -511,18 +602,22 @@ def query_11(trackpoint):
         },
         {"$limit": 20},
     ]
-    result = list(trackpoint.aggregate(query, allowDiskUse=True))
-    pprint.pprint(result)
+    return list(trackpoint.aggregate(query, allowDiskUse=True))
 
 def query_12(trackpoint):
     """Find answers to question 12 by MongoDB queries.
 
-    Results are printed to the console.
+    Results are returned as a list of documents.
 
     Parameters
     ----------
     trackpoint : :obj:
         The pymongo collection object for trackpoint.
+
+    Returns
+    -------
+    list of dict
+        The resulting documents.
     """
     query = [
         {
@@ -558,5 +653,46 @@ def query_12(trackpoint):
         {"$group": {"_id": "$user._id", "numInvalidActivities": {"$count": {}},}},
         {"$sort": {"numInvalidActivities": -1}},
     ]
-    result = list(trackpoint.aggregate(query, allowDiskUse=True))
-    pprint.pprint(result)
+    return list(trackpoint.aggregate(query, allowDiskUse=True))
+
+
+def print_result(result):
+    """Print the result of a query function to the console.
+
+    Parameters
+    ----------
+    result : list of dict or :obj:`pandas.DataFrame`
+        The result returned by a query function.
+    """
+    if isinstance(result, pd.DataFrame):
+        print(tabulate(result, headers="keys", showindex=False, tablefmt="orgtbl"))
+    else:
+        pprint.pprint(result)
+
+
+# Query functions keyed on question number, with the names of the collections
+# each function takes as arguments (in order).
+QUERIES = {
+    1: (query_1, ("user", "activity", "trackpoint")),
+    2: (query_2, ("user",)),
+    3: (query_3, ("user",)),
+    4: (query_4, ("activity",)),
+    5: (query_5, ("activity",)),
+    6: (query_6, ("user", "trackpoint")),
+    7: (query_7, ("user", "activity")),
+    8: (query_8, ("activity",)),
+    9: (query_9, ("user", "activity")),
+    10: (query_10, ("user", "activity", "trackpoint")),
+    11: (query_11, ("trackpoint",)),
+    12: (query_12, ("trackpoint",)),
+}
+
+# Queries that may read the simplified trackpoint tier instead of trackpoint,
+# with how the simplification affects their results
+SIMPLIFIABLE = {
+    6: "exact count on the simplified trackpoints, with no bound on the count",
+    10: "lower bound of the distance along the full trajectories",
+}
+
+# Queries that take the `partition_granularity` of the trackpoints
+PARTITIONABLE = {10}
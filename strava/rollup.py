@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""Code to maintain and query rollup collections.
+
+This module contains code that pre-aggregates the `activity` collection at
+ingest into the `rollup` collection, with one document per user, year-month
+and transportation mode holding the number of activities, the recorded hours
+and the distance covered. The rollups are written with `$merge`. When
+additional activities are ingested, the rollups of their users are recomputed
+and replaced, so the rollups are updated incrementally, and updating them
+twice for the same activities gives the same result. Queries 2, 3, 8 and 9
+are answered from the rollups instead of scanning and joining the `user` and
+`activity` collections.
+"""
+
+import pandas as pd
+
+# Mean earth radius in kilometers
+EARTH_RADIUS_KM = 6371.0088
+
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    """Return an aggregation expression for the haversine distance in km."""
+    phi1 = {"$degreesToRadians": lat1}
+    phi2 = {"$degreesToRadians": lat2}
+    half_dphi = {"$divide": [{"$subtract": [phi2, phi1]}, 2]}
+    half_dlambda = {
+        "$divide": [
+            {"$subtract": [{"$degreesToRadians": lon2}, {"$degreesToRadians": lon1}]},
+            2,
+        ]
+    }
+    a = {
+        "$add": [
+            {"$pow": [{"$sin": half_dphi}, 2]},
+            {
+                "$multiply": [
+                    {"$cos": phi1},
+                    {"$cos": phi2},
+                    {"$pow": [{"$sin": half_dlambda}, 2]},
+                ]
+            },
+        ]
+    }
+    return {"$multiply": [2 * EARTH_RADIUS_KM, {"$asin": {"$sqrt": a}}]}
+
+
+def _year_month(date):
+    """Return an aggregation expression formatting a date as `YYYY-MM`."""
+    return {"$dateToString": {"format": "%Y-%m", "date": date}}
+
+
+def update_rollups(db, activity_ids=None):
+    """Aggregate activities into the `rollup` collection.
+
+    First the distance of each activity is computed from its trackpoints and
+    merged into `activity_distance`. Then the activities are grouped by user,
+    year-month of the start time and transportation mode, and merged into
+    `rollup`.
+
+    Parameters
+    ----------
+    db : :obj:
+        The pymongo database object.
+    activity_ids : list of int, optional
+        The newly ingested activities. Their users must already be inserted.
+        The rollups of these users are recomputed from all their activities
+        and replace the existing ones. If not given, the rollups are rebuilt
+        from all activities.
+    """
+    if activity_ids is None:
+        db["activity_distance"].drop()
+        db["rollup"].drop()
+        trackpoint_match = []
+        activity_match = []
+    else:
+        # Recompute every rollup of the users of the new activities
+        users = list(
+            db["user"].find({"activity_id": {"$in": activity_ids}}, {"activity_id": 1})
+        )
+        user_activity_ids = [aid for user in users for aid in user["activity_id"]]
+        trackpoint_match = [{"$match": {"activity_id": {"$in": activity_ids}}}]
+        activity_match = [{"$match": {"_id": {"$in": user_activity_ids}}}]
+        db["rollup"].delete_many({"user_id": {"$in": [user["_id"] for user in users]}})
+
+    # Distance of each activity
+    db["trackpoint"].aggregate(
+        trackpoint_match
+        + [
+            {
+                "$setWindowFields": {
+                    "partitionBy": "$activity_id",
+                    "sortBy": {"_id": 1},
+                    "output": {
+                        "prevLat": {"$shift": {"output": "$lat", "by": -1}},
+                        "prevLon": {"$shift": {"output": "$lon", "by": -1}},
+                    },
+                }
+            },
+            {
+                "$group": {
+                    "_id": "$activity_id",
+                    "distance_km": {
+                        "$sum": {
+                            "$cond": [
+                                {"$eq": ["$prevLat", None]},
+                                0,
+                                _haversine_km("$prevLat", "$prevLon", "$lat", "$lon"),
+                            ]
+                        }
+                    },
+                }
+            },
+            {"$merge": {"into": "activity_distance", "whenMatched": "replace"}},
+        ],
+        allowDiskUse=True,
+    )
+
+    # User x year-month x transportation mode
+    db["activity"].aggregate(
+        activity_match
+        + [
+            {
+                "$lookup": {
+                    "from": "user",
+                    "localField": "_id",
+                    "foreignField": "activity_id",
+                    "as": "join_key",
+                }
+            },
+            {
+                "$lookup": {
+                    "from": "activity_distance",
+                    "localField": "_id",
+                    "foreignField": "_id",
+                    "as": "distance",
+                }
+            },
+            {
+                "$group": {
+                    "_id": {
+                        "user_id": {"$first": "$join_key._id"},
+                        "year_month": _year_month("$start_date_time"),
+                        # Unlabeled activities have NaN as transportation mode
+                        "transportation_mode": {
+                            "$cond": [
+                                {"$eq": [{"$type": "$transportation_mode"}, "string"]},
+                                "$transportation_mode",
+                                None,
+                            ]
+                        },
+                    },
+                    "activity_count": {"$sum": 1},
+                    "recorded_hours": {
+                        "$sum": {
+                            "$divide": [
+                                {"$subtract": ["$end_date_time", "$start_date_time"]},
+                                3600000,
+                            ]
+                        }
+                    },
+                    "distance_km": {
+                        "$sum": {"$ifNull": [{"$first": "$distance.distance_km"}, 0]}
+                    },
+                    "month_spanning": {
+                        "$sum": {
+                            "$cond": [
+                                {
+                                    "$eq": [
+                                        _year_month("$start_date_time"),
+                                        _year_month("$end_date_time"),
+                                    ]
+                                },
+                                0,
+                                1,
+                            ]
+                        }
+                    },
+                }
+            },
+            {
+                "$set": {
+                    "user_id": "$_id.user_id",
+                    "year_month": "$_id.year_month",
+                    "transportation_mode": "$_id.transportation_mode",
+                }
+            },
+            {"$merge": {"into": "rollup", "whenMatched": "replace"}},
+        ],
+        allowDiskUse=True,
+    )
+    db["rollup"].create_index([("year_month", 1), ("user_id", 1)])
+
+
+def rollup_query_2(user, rollup):
+    """Find answers to question 2 from the rollups.
+
+    Parameters
+    ----------
+    user : :obj:
+        The pymongo collection object for user.
+    rollup : :obj:
+        The pymongo collection object for rollup.
+
+    Returns
+    -------
+    list of dict
+        The resulting documents.
+    """
+    per_user = [
+        item["NumberOfActivities"]
+        for item in rollup.aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": "$user_id",
+                        "NumberOfActivities": {"$sum": "$activity_count"},
+                    }
+                }
+            ]
+        )
+    ]
+    # Users without activities are not in the rollups
+    number_of_users = user.count_documents({})
+    if number_of_users == 0:
+        return []
+    return [
+        {
+            "_id": "ActivitiesPerUser",
+            "Average": sum(per_user) / number_of_users,
+            "Minimum": min(per_user) if len(per_user) == number_of_users else 0,
+            "Maximum": max(per_user, default=0),
+        }
+    ]
+
+
+def rollup_query_3(rollup):
+    """Find answers to question 3 from the rollups.
+
+    Parameters
+    ----------
+    rollup : :obj:
+        The pymongo collection object for rollup.
+
+    Returns
+    -------
+    list of dict
+        The resulting documents.
+    """
+    query = [
+        {
+            "$group": {
+                "_id": "$user_id",
+                "NumberOfActivities": {"$sum": "$activity_count"},
+            }
+        },
+        {"$sort": {"NumberOfActivities": -1}},
+        {"$limit": 10},
+    ]
+    return list(rollup.aggregate(query))
+
+
+def rollup_query_8(rollup):
+    """Find answers to question 8 from the rollups.
+
+    Parameters
+    ----------
+    rollup : :obj:
+        The pymongo collection object for rollup.
+
+    Returns
+    -------
+    list of dict
+        The resulting documents.
+    """
+    query = [
+        {"$match": {"transportation_mode": {"$ne": None}}},
+        {
+            "$group": {
+                "_id": "$transportation_mode",
+                "user_ids": {"$addToSet": "$user_id"},
+            }
+        },
+        {"$project": {"_id": "$_id", "myCount": {"$size": "$user_ids"}}},
+    ]
+    return list(rollup.aggregate(query))
+
+
+def rollup_query_9(rollup):
+    """Find answers to question 9 from the rollups.
+
+    Parameters
+    ----------
+    rollup : :obj:
+        The pymongo collection object for rollup.
+
+    Returns
+    -------
+    :obj:`pandas.DataFrame`
+        The number of activities and recorded hours of the two most active
+        users in the most active year-month.
+    """
+    # Find most active year-month
+    year_month_ma = list(
+        rollup.aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": "$year_month",
+                        "count": {"$sum": "$activity_count"},
+                    }
+                },
+                {"$sort": {"count": -1}},
+                {"$limit": 1},
+            ]
+        )
+    )[0]["_id"]
+    # Find most active and second most active user in most active year-month
+    users = list(
+        rollup.aggregate(
+            [
+                {"$match": {"year_month": year_month_ma}},
+                {
+                    "$group": {
+                        "_id": "$user_id",
+                        "number_of_activities": {"$sum": "$activity_count"},
+                        "recorded_hours": {"$sum": "$recorded_hours"},
+                        "month_spanning": {"$sum": "$month_spanning"},
+                    }
+                },
+                {"$sort": {"number_of_activities": -1}},
+                {"$limit": 2},
+            ]
+        )
+    )
+
+    # Assert that these users did not record any activities that started in
+    # one month and ended in another
+    assert all(item["month_spanning"] == 0 for item in users)
+
+    result_df = (
+        pd.DataFrame(users)
+        .rename(columns={"_id": "user_id"})
+        .sort_values(by="user_id")
+        .reset_index(drop=True)
+    )
+    result_df = result_df[["user_id", "recorded_hours", "number_of_activities"]]
+    result_df["year_month"] = pd.to_datetime(year_month_ma).strftime("%Y-%B")
+    return result_df
+
+
+# Rollup query functions keyed on question number, with the names of the
+# collections each function takes as arguments (in order).
+ROLLUP = {
+    2: (rollup_query_2, ("user", "rollup")),
+    3: (rollup_query_3, ("rollup",)),
+    8: (rollup_query_8, ("rollup",)),
+    9: (rollup_query_9, ("rollup",)),
+}
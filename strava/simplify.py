@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Code to simplify trajectories for the simplified trackpoint tier.
+
+This module contains a Douglas-Peucker line simplification of the trackpoints
+of each activity. Every discarded trackpoint lies within the given tolerance
+(in meters) of the simplified trajectory, which is the error bound of queries
+run against the simplified tier. Distances summed along a simplified
+trajectory are lower bounds of the distances along the full trajectory.
+"""
+import itertools
+import numpy as np
+
+# Mean earth radius in meters
+# https://en.wikipedia.org/wiki/Earth_radius#Arithmetic_mean_radius
+EARTH_RADIUS = 6371008.8
+
+
+def douglas_peucker(lat, lon, tolerance):
+    """Simplify a trajectory with the Douglas-Peucker algorithm.
+
+    The coordinates are projected to meters with an equirectangular
+    projection centred on the mean latitude of the trajectory, which is
+    accurate for the extent of a single activity.
+
+    Parameters
+    ----------
+    lat : :obj:`numpy.ndarray`
+        Latitudes in degrees.
+    lon : :obj:`numpy.ndarray`
+        Longitudes in degrees.
+    tolerance : float
+        Maximum distance in meters from a discarded point to the simplified
+        trajectory.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        Boolean mask of the points to keep. The first and last points are
+        always kept.
+    """
+    n = len(lat)
+    keep = np.zeros(n, dtype=bool)
+    if n < 3:
+        keep[:] = True
+        return keep
+    keep[0] = keep[-1] = True
+
+    lat0 = np.radians(np.mean(lat))
+    x = np.radians(lon) * np.cos(lat0) * EARTH_RADIUS
+    y = np.radians(lat) * EARTH_RADIUS
+
+    # Iterative instead of recursive to handle long trajectories
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        px = x[start + 1 : end] - x[start]
+        py = y[start + 1 : end] - y[start]
+        dx = x[end] - x[start]
+        dy = y[end] - y[start]
+        length = dx * dx + dy * dy
+        # Distance from each point to the segment between start and end
+        if length == 0:
+            dist = np.hypot(px, py)
+        else:
+            t = np.clip((px * dx + py * dy) / length, 0, 1)
+            dist = np.hypot(px - t * dx, py - t * dy)
+        i = np.argmax(dist)
+        if dist[i] > tolerance:
+            mid = start + 1 + i
+            keep[mid] = True
+            stack.append((start, mid))
+            stack.append((mid, end))
+    return keep
+
+
+def simplify_trackpoints(trackpoint_dict, tolerance):
+    """Simplify the trajectory of each activity.
+
+    Parameters
+    ----------
+    trackpoint_dict : list of dict
+        Collection of trackpoints, ordered by activity and time.
+    tolerance : float
+        Maximum distance in meters from a discarded trackpoint to the
+        simplified trajectory of its activity.
+
+    Returns
+    -------
+    list of dict
+        The trackpoints kept in the simplified trajectories. The documents
+        are shared with `trackpoint_dict`.
+    """
+    simplified = []
+    for _, group in itertools.groupby(trackpoint_dict, key=lambda r: r["activity_id"]):
+        group = list(group)
+        lat = np.array([r["lat"] for r in group], dtype=float)
+        lon = np.array([r["lon"] for r in group], dtype=float)
+        keep = douglas_peucker(lat, lon, tolerance)
+        simplified.extend(r for r, k in zip(group, keep) if k)
+    return simplified
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""Make the modules in `strava` importable, as when run from that folder."""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "strava"))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Tests for the sketches and sampling estimators of the approximate queries."""
+import numpy as np
+import pytest
+from approximate import HyperLogLog
+from approximate import estimate_total
+from approximate import sample_size
+
+
+@pytest.mark.parametrize("n", [10, 1000, 50000])
+def test_count_within_standard_error(n):
+    sketch = HyperLogLog()
+    sketch.update(range(n))
+    # Four standard errors, so the test practically never fails by chance
+    assert abs(sketch.count() - n) <= 4 * sketch.standard_error * n + 1
+
+
+def test_small_precision_error_bound():
+    errors = []
+    for seed in range(20):
+        sketch = HyperLogLog(precision=8)
+        sketch.update(f"{seed}-{i}" for i in range(5000))
+        errors.append(sketch.count() / 5000 - 1)
+    # The observed relative error matches the standard error of 2^8 registers
+    assert abs(np.mean(errors)) < 2 * sketch.standard_error
+    assert np.std(errors) < 2 * sketch.standard_error
+
+
+def test_duplicates_are_not_counted():
+    sketch = HyperLogLog()
+    for _ in range(10):
+        sketch.update(str(i) for i in range(100))
+    assert round(sketch.count()) == 100
+
+
+def test_empty_sketch():
+    assert HyperLogLog().count() == 0
+
+
+def test_merge_counts_union():
+    a = HyperLogLog()
+    b = HyperLogLog()
+    a.update(range(0, 20000))
+    b.update(range(10000, 30000))
+    union = HyperLogLog()
+    union.update(range(0, 30000))
+
+    a.merge(b)
+    # Merging is the same as adding all values to one sketch
+    assert np.array_equal(a.registers, union.registers)
+    assert abs(a.count() - 30000) <= 4 * a.standard_error * 30000
+
+
+def test_merge_different_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(precision=10).merge(HyperLogLog(precision=12))
+
+
+def test_document_round_trip():
+    sketch = HyperLogLog(precision=10)
+    sketch.update(range(500))
+    document = sketch.to_document("users")
+    restored = HyperLogLog.from_document(document)
+
+    assert document["_id"] == "users"
+    assert restored.precision == 10
+    assert np.array_equal(restored.registers, sketch.registers)
+    assert restored.count() == sketch.count()
+
+
+def test_sample_size_grows_with_variation_and_precision():
+    even = [9.0, 10.0, 11.0] * 10
+    skewed = [1.0, 10.0, 30.0] * 10
+
+    assert sample_size(skewed, 10000, 0.05, 0.95) > sample_size(
+        even, 10000, 0.05, 0.95
+    )
+    assert sample_size(even, 10000, 0.01, 0.95) > sample_size(
+        even, 10000, 0.05, 0.95
+    )
+
+
+def test_sample_size_is_bounded():
+    values = [1.0, 10.0, 30.0] * 10
+    # Never more than the population, never less than the pilot sample
+    assert sample_size(values, 40, 0.001, 0.95) == 40
+    assert sample_size(values, 10000, 10.0, 0.95) == len(values)
+
+
+def test_sample_size_meets_error_target():
+    rng = np.random.default_rng(0)
+    population = rng.exponential(5.0, 5000)
+    pilot = list(rng.choice(population, 30, replace=False))
+    n = sample_size(pilot, len(population), 0.05, 0.95)
+    misses = 0
+    for _ in range(200):
+        sample = list(rng.choice(population, n, replace=False))
+        estimate = estimate_total(sample, len(population), 0.95)
+        low, high = estimate["ConfidenceInterval"]
+        assert (high - low) / 2 <= 0.1 * population.sum()
+        misses += not low <= population.sum() <= high
+    # Roughly 5% of the intervals miss the true total
+    assert misses < 25
+
+
+def test_estimate_total_of_whole_population_is_exact():
+    values = [2.0, 4.0, 9.0]
+    estimate = estimate_total(values, 3, 0.95)
+
+    assert estimate["Estimate"] == 15.0
+    assert estimate["ConfidenceInterval"] == [15.0, 15.0]
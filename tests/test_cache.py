@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Tests for the on-disk query result cache."""
+import os
+from cache import ResultCache
+
+
+class Counter:
+    """Query function counting how often it is called."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return {"args": list(args), "kwargs": kwargs, "call": self.calls}
+
+
+def _entries(directory):
+    return sorted(f for f in os.listdir(directory) if f.endswith(".pkl"))
+
+
+def test_hit_and_miss(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    query = Counter()
+
+    first = cache.fetch("query_1", "epoch", query, 1, mode="a")
+    second = cache.fetch("query_1", "epoch", query, 1, mode="a")
+    assert query.calls == 1
+    assert second == first
+
+    # Different arguments or names are different entries
+    cache.fetch("query_1", "epoch", query, 2, mode="a")
+    cache.fetch("query_1", "epoch", query, 1, mode="b")
+    cache.fetch("query_2", "epoch", query, 1, mode="a")
+    assert query.calls == 4
+    assert len(_entries(tmp_path)) == 4
+
+
+def test_no_epoch_is_not_cached(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    query = Counter()
+
+    cache.fetch("query_1", None, query)
+    cache.fetch("query_1", None, query)
+    assert query.calls == 2
+    assert _entries(tmp_path) == []
+
+
+def test_new_epoch_invalidates(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    query = Counter()
+
+    cache.fetch("query_1", "old", query)
+    cache.fetch("query_2", "old", query)
+    result = cache.fetch("query_1", "new", query)
+    assert query.calls == 3
+    assert result["call"] == 3
+    # Results of the old epoch are removed
+    assert [f.split("-")[0] for f in _entries(tmp_path)] == ["new"]
+
+
+def test_least_recently_used_is_evicted(tmp_path):
+    cache = ResultCache(str(tmp_path), max_entries=2)
+    query = Counter()
+
+    cache.fetch("query_1", "epoch", query)
+    cache.fetch("query_2", "epoch", query)
+    # Age both entries, then use query_1 so query_2 is least recently used
+    for filename in _entries(tmp_path):
+        os.utime(os.path.join(tmp_path, filename), (0, 0))
+    cache.fetch("query_1", "epoch", query)
+    cache.fetch("query_3", "epoch", query)
+    assert query.calls == 3
+    assert len(_entries(tmp_path)) == 2
+
+    cache.fetch("query_1", "epoch", query)
+    cache.fetch("query_3", "epoch", query)
+    assert query.calls == 3
+    cache.fetch("query_2", "epoch", query)
+    assert query.calls == 4
+
+
+def test_clear(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    query = Counter()
+
+    cache.fetch("query_1", "epoch", query)
+    cache.clear()
+    assert _entries(tmp_path) == []
+    cache.fetch("query_1", "epoch", query)
+    assert query.calls == 2
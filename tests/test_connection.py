@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""Tests for the shared connection and its settings."""
+from pymongo.uri_parser import parse_uri
+from connection import Connection
+from main import build_parser, connect
+
+
+def test_uri_escapes_login():
+    connection = Connection("user@lab", "p@ss:w/rd", "localhost:27017", "strava")
+    parsed = parse_uri(connection.uri)
+    assert parsed["username"] == "user@lab"
+    assert parsed["password"] == "p@ss:w/rd"
+    assert parsed["nodelist"] == [("localhost", 27017)]
+    assert parsed["database"] == "strava"
+
+
+def test_uri_without_login():
+    connection = Connection(None, None, "localhost", "strava")
+    assert connection.uri == "mongodb://localhost/strava"
+
+
+def test_timeout_and_pool_settings(monkeypatch):
+    monkeypatch.setenv("STRAVA_PASSWORD", "secret")
+    monkeypatch.setenv("STRAVA_TIMEOUT_MS", "5000")
+    args = build_parser().parse_args(
+        ["query", "--user", "strava", "--min-pool-size", "2"]
+    )
+    connection = connect(args)
+    assert connection.options["serverSelectionTimeoutMS"] == 5000
+    assert connection.options["connectTimeoutMS"] == 5000
+    assert connection.options["minPoolSize"] == 2
+    assert connection.options["maxPoolSize"] == 100
+
+    # The command line takes precedence over the environment
+    args = build_parser().parse_args(
+        ["query", "--user", "strava", "--timeout-ms", "1000"]
+    )
+    assert connect(args).options["connectTimeoutMS"] == 1000
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Tests for parsing the `.plt` files into collection dictionaries."""
+import datetime
+import pandas as pd
+import pytest
+import database
+import memory
+
+# Number of trajectory files of each user, and whether the user is labeled
+USERS = {"000": (3, True), "001": (0, False), "002": (2, False), "003": (4, True)}
+
+
+def _write_trajectory(path, start, n):
+    """Write a `.plt` file with `n` trackpoints one minute apart."""
+    lines = ["Geolife trajectory", "WGS 84", "Altitude is in Feet", "Reserved 3"]
+    lines += ["0,2,255,My Track,0,0,2,8421376", "0"]
+    for i in range(n):
+        time = start + datetime.timedelta(minutes=i)
+        days = (time - datetime.datetime(1899, 12, 30)).total_seconds() / 86400
+        altitude = -777 if i == 1 else 100 + i
+        lines.append(
+            f"{39.9 + i * 1e-4},{116.4 + i * 1e-4},0,{altitude},{days},"
+            f"{time:%Y-%m-%d},{time:%H:%M:%S}"
+        )
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    """Create a small dataset and run from the `strava` folder next to it."""
+    data = tmp_path / "dataset" / "Data"
+    labeled = []
+    for uid, (files, has_labels) in USERS.items():
+        trajectory = data / uid / "Trajectory"
+        trajectory.mkdir(parents=True)
+        labels = []
+        for i in range(files):
+            start = datetime.datetime(2008, 4, 1 + i, 10, int(uid))
+            _write_trajectory(trajectory / f"{start:%Y%m%d%H%M%S}.plt", start, 5 + i)
+            end = start + datetime.timedelta(minutes=4 + i)
+            labels.append(f"{start:%Y/%m/%d %H:%M:%S}\t{end:%Y/%m/%d %H:%M:%S}\twalk")
+            if i == 1:
+                # Duplicate label, which creates an additional activity
+                labels.append(
+                    f"{start:%Y/%m/%d %H:%M:%S}\t{end:%Y/%m/%d %H:%M:%S}\tbus"
+                )
+        if has_labels:
+            labeled.append(uid)
+            with open(data / uid / "labels.txt", "w") as f:
+                f.write("Start Time\tEnd Time\tTransportation Mode\n")
+                f.write("\n".join(labels) + "\n")
+    with open(tmp_path / "dataset" / "labeled_ids.txt", "w") as f:
+        f.write("\n".join(labeled) + "\n")
+    (tmp_path / "strava").mkdir()
+    monkeypatch.chdir(tmp_path / "strava")
+    return tmp_path
+
+
+def _frame(records):
+    return pd.DataFrame(records).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("users_per_chunk", [1, 2, 3, 10])
+def test_chunks_match_parse_data(dataset, users_per_chunk):
+    user_dict, activity_dict, trackpoint_dict = database.parse_data()
+    chunks = list(database.iter_parse_data(users_per_chunk))
+
+    assert len(chunks) == -(-len(USERS) // users_per_chunk)
+    chunk_users = [u for chunk in chunks for u in chunk[0]]
+    chunk_activities = [a for chunk in chunks for a in chunk[1]]
+    chunk_trackpoints = [t for chunk in chunks for t in chunk[2]]
+
+    assert [(u["_id"], u["has_labels"], sorted(u["activity_id"])) for u in user_dict] == [
+        (u["_id"], u["has_labels"], sorted(u["activity_id"])) for u in chunk_users
+    ]
+    pd.testing.assert_frame_equal(_frame(activity_dict), _frame(chunk_activities))
+    pd.testing.assert_frame_equal(_frame(trackpoint_dict), _frame(chunk_trackpoints))
+
+
+def test_parse_data(dataset):
+    user_dict, activity_dict, trackpoint_dict = database.parse_data()
+
+    # One activity per file, and one more for the duplicate labels
+    assert len(activity_dict) == 3 + 1 + 2 + 4 + 1
+    # The trackpoints of the duplicate labels are stored for both activities
+    assert len(trackpoint_dict) == sum(
+        sum(5 + i for i in range(files)) + (6 if labeled else 0)
+        for files, labeled in USERS.values()
+    )
+    assert [t["_id"] for t in trackpoint_dict] == list(range(len(trackpoint_dict)))
+    assert sorted(a["_id"] for a in activity_dict) == list(range(len(activity_dict)))
+    users = {u["_id"]: u for u in user_dict}
+    assert users["001"]["activity_id"] == []
+    assert users["000"]["has_labels"] and not users["002"]["has_labels"]
+    modes = [a["transportation_mode"] for a in activity_dict]
+    assert modes.count("bus") == 2
+    # Invalid altitudes are replaced
+    assert all(t["altitude"] != -777 for t in trackpoint_dict)
+
+
+def test_parse_data_checks_memory_budget(dataset):
+    # A budget that is already exceeded, as after an aborted parse
+    memory.set_budget(memory.current_rss() - 1, "chunk")
+    try:
+        with pytest.raises(memory.MemoryBudgetExceeded):
+            database.parse_data()
+        with pytest.raises(memory.MemoryBudgetExceeded):
+            next(database.iter_parse_data(2))
+        # Applied to the memory growth, the same budget is met
+        with memory.relative_budget():
+            assert len(list(database.iter_parse_data(2))) == 2
+    finally:
+        memory.set_budget(None)
+
+
+def test_parse_data_stages(dataset):
+    profiler = memory.MemoryProfiler()
+    with profiler.stage("parse_data"):
+        database.parse_data(profiler.stage)
+
+    stages = [record["stage"] for record in profiler.stages]
+    assert stages == ["parse_data", "read_files", "concat", "to_dict"]
+    outer = profiler.stages[0]
+    assert all(outer["peak_traced"] >= r["peak_traced"] for r in profiler.stages)
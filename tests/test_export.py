@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Tests for exporting query results to columnar files."""
+import pandas as pd
+import pytest
+from export import export_collection, export_result
+
+pa = pytest.importorskip("pyarrow")
+
+
+@pytest.mark.parametrize("fmt", ["parquet", "ipc"])
+def test_export_result_duplicate_columns(tmp_path, fmt):
+    # Query 7 returns user ids in four columns with the same name
+    df = pd.DataFrame(
+        [["000", "001", "002", "003"], ["004", "005", "006", "007"]],
+        columns=["user_id"] * 4,
+    )
+    path = str(tmp_path / f"query_7.{fmt}")
+    export_result(df, path, fmt)
+
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path)
+    else:
+        table = pa.ipc.open_file(path).read_all()
+    assert table.column_names == ["user_id", "user_id_1", "user_id_2", "user_id_3"]
+    assert table.column("user_id_3").to_pylist() == ["003", "007"]
+    # The result itself is not modified
+    assert list(df.columns) == ["user_id"] * 4
+
+
+def test_export_result_documents(tmp_path):
+    import pyarrow.parquet as pq
+
+    path = str(tmp_path / "query_3.parquet")
+    export_result([{"_id": "128", "NumberOfActivities": 2102}], path)
+    assert pq.read_table(path).to_pylist() == [
+        {"_id": "128", "NumberOfActivities": 2102}
+    ]
+
+
+class _Collection:
+    """A collection without activity ids, answering `find` from a list."""
+
+    name = "user"
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self, filter, projection, batch_size=None):
+        return iter(self.documents)
+
+
+def test_export_collection_workers_without_range_field(tmp_path):
+    import pyarrow.parquet as pq
+
+    user = {"_id": "000", "has_labels": False, "activity_id": [1, 2]}
+    paths = export_collection(_Collection([user]), str(tmp_path / "user"), workers=4)
+    # Always a directory of part files with several workers
+    assert paths == [str(tmp_path / "user" / "part-00000.parquet")]
+    assert pq.read_table(paths[0]).to_pylist() == [user]
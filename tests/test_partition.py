@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Tests for the time partition keys and filters."""
+from datetime import datetime
+import pytest
+from partition import add_partition_keys, partition_filter, partition_key
+
+
+def test_partition_key():
+    date = datetime(2008, 3, 14, 12, 30)
+    assert partition_key(date, "year") == 2008
+    assert partition_key(date, "month") == 200803
+
+
+def test_partition_key_unknown_granularity():
+    with pytest.raises(ValueError):
+        partition_key(datetime(2008, 1, 1), "week")
+
+
+def test_add_partition_keys():
+    trackpoints = [
+        {"date_time": datetime(2008, 12, 31)},
+        {"date_time": datetime(2009, 1, 1)},
+    ]
+    add_partition_keys(trackpoints, "month")
+    assert [tp["partition"] for tp in trackpoints] == [200812, 200901]
+
+
+def test_filter_without_partitions():
+    start, end = datetime(2008, 1, 1), datetime(2009, 1, 1)
+    assert partition_filter(None, start, end) == {
+        "date_time": {"$gte": start, "$lt": end}
+    }
+
+
+def test_year_filter_excludes_end():
+    start, end = datetime(2008, 1, 1), datetime(2009, 1, 1)
+    time_filter = partition_filter("year", start, end)
+
+    assert time_filter["date_time"] == {"$gte": start, "$lt": end}
+    # The exclusive end falls in 2009, but the last included instant in 2008
+    assert time_filter["partition"] == {"$gte": 2008, "$lte": 2008}
+
+
+def test_year_filter_includes_end_partition_after_boundary():
+    time_filter = partition_filter(
+        "year", datetime(2008, 6, 1), datetime(2009, 1, 1, 0, 0, 0, 1)
+    )
+    assert time_filter["partition"] == {"$gte": 2008, "$lte": 2009}
+
+
+def test_month_filter_excludes_end():
+    time_filter = partition_filter("month", datetime(2008, 1, 1), datetime(2008, 3, 1))
+    assert time_filter["partition"] == {"$gte": 200801, "$lte": 200802}
+
+
+def test_month_filter_across_years():
+    time_filter = partition_filter(
+        "month", datetime(2008, 12, 15), datetime(2009, 1, 1)
+    )
+    assert time_filter["partition"] == {"$gte": 200812, "$lte": 200812}
+
+    time_filter = partition_filter(
+        "month", datetime(2008, 12, 15), datetime(2009, 1, 2)
+    )
+    assert time_filter["partition"] == {"$gte": 200812, "$lte": 200901}
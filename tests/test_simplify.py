@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Tests for the Douglas-Peucker simplification of trajectories."""
+import numpy as np
+import pytest
+from simplify import EARTH_RADIUS, douglas_peucker, simplify_trackpoints
+
+
+def _random_walk(n, seed):
+    """Return a random trajectory of `n` points around Beijing."""
+    rng = np.random.default_rng(seed)
+    lat = 39.9 + np.cumsum(rng.normal(0, 1e-4, n))
+    lon = 116.4 + np.cumsum(rng.normal(0, 1e-4, n))
+    return lat, lon
+
+
+def _distance_to_segment(lat, lon, i, start, end):
+    """Distance in meters from point `i` to the segment from `start` to `end`."""
+    lat0 = np.radians(np.mean(lat))
+    x = np.radians(lon) * np.cos(lat0) * EARTH_RADIUS
+    y = np.radians(lat) * EARTH_RADIUS
+    p = np.array([x[i], y[i]])
+    a = np.array([x[start], y[start]])
+    b = np.array([x[end], y[end]])
+    ab = b - a
+    if not ab.any():
+        return np.linalg.norm(p - a)
+    t = np.clip(np.dot(p - a, ab) / np.dot(ab, ab), 0, 1)
+    return np.linalg.norm(p - (a + t * ab))
+
+
+@pytest.mark.parametrize("tolerance", [1, 10, 50])
+@pytest.mark.parametrize("seed", range(5))
+def test_dropped_points_within_tolerance(tolerance, seed):
+    lat, lon = _random_walk(500, seed)
+    keep = douglas_peucker(lat, lon, tolerance)
+    kept = np.flatnonzero(keep)
+
+    assert keep[0] and keep[-1]
+    assert 2 <= len(kept) <= len(lat)
+    for start, end in zip(kept[:-1], kept[1:]):
+        for i in range(start + 1, end):
+            assert _distance_to_segment(lat, lon, i, start, end) <= tolerance
+
+
+def test_larger_tolerance_keeps_fewer_points():
+    lat, lon = _random_walk(500, 0)
+    counts = [douglas_peucker(lat, lon, t).sum() for t in (1, 10, 100)]
+    assert counts[0] >= counts[1] >= counts[2]
+
+
+def test_straight_line_keeps_endpoints():
+    lat = np.linspace(39.9, 40.0, 100)
+    lon = np.linspace(116.4, 116.5, 100)
+    keep = douglas_peucker(lat, lon, 1)
+    assert np.flatnonzero(keep).tolist() == [0, 99]
+
+
+def test_short_trajectories_are_kept():
+    for n in range(3):
+        lat, lon = _random_walk(n, 0)
+        assert douglas_peucker(lat, lon, 10).all()
+
+
+def test_repeated_points():
+    lat = np.full(10, 39.9)
+    lon = np.full(10, 116.4)
+    keep = douglas_peucker(lat, lon, 1)
+    assert np.flatnonzero(keep).tolist() == [0, 9]
+
+
+def test_simplify_trackpoints_per_activity():
+    trackpoint_dict = []
+    for activity_id in range(3):
+        lat, lon = _random_walk(200, activity_id)
+        trackpoint_dict.extend(
+            {"_id": len(trackpoint_dict), "activity_id": activity_id, "lat": a, "lon": o}
+            for a, o in zip(lat, lon)
+        )
+    simplified = simplify_trackpoints(trackpoint_dict, 10)
+
+    assert len(simplified) < len(trackpoint_dict)
+    for activity_id in range(3):
+        ids = [r["_id"] for r in simplified if r["activity_id"] == activity_id]
+        # The first and last trackpoint of each activity are kept
+        assert ids[0] == activity_id * 200
+        assert ids[-1] == activity_id * 200 + 199
+        assert ids == sorted(ids)